@@ -34,12 +34,79 @@
     $ sudo expirefiles.py find /scratch
     ~~~
 
+    The filesystem is walked by a pool of threads (default 16). On a parallel
+    filesystem more threads give more metadata requests in flight.
+    ~~~
+    $ sudo expirefiles.py find --workers 64 /scratch
+    ~~~
+
+    Every find records the state of each directory. An incremental find only
+    reads directories that changed since, or that hold files that may now be
+    old enough to delete. Files whose access time is set backwards (eg. by
+    touch -a) in an unchanged directory are not seen until the next full find.
+    ~~~
+    $ sudo expirefiles.py find --incremental /scratch
+    ~~~
+
+    A running find checkpoints its progress every 5 minutes. The list of the
+    previous find is only replaced once the scan completes, and an interrupted
+    find can be continued from its last checkpoint.
+    ~~~
+    $ sudo expirefiles.py find --resume /scratch
+    ~~~
+
+    A find can be split into shards to run on several hosts at once, each
+    taking a share of the directories two levels down. Once every shard is
+    done their lists are merged, as if found by a single find.
+    ~~~
+    host1$ sudo expirefiles.py find --shard 0/2 /scratch
+    host2$ sudo expirefiles.py find --shard 1/2 /scratch
+    host1$ sudo expirefiles.py merge --shards 2 /scratch
+    ~~~
+
+    Each find writes its lists and index to a new generation under
+    *.expirefiles/generations*, and *.expirefiles/current* is only pointed
+    at it once it is complete, so list and notify keep to the previous one
+    meanwhile. The last 3 generations are kept (generations in config.ini)
+    and going back to an earlier one only changes that link.
+    ~~~
+    $ sudo expirefiles.py generations /scratch
+    $ sudo expirefiles.py rollback /scratch
+    $ sudo expirefiles.py rollback --generation 20160301-020000 /scratch
+    ~~~
+
+    The candidate files of each user added, removed and still there since the
+    previous generation, or between any two, are counted by diff. With
+    --enforce the exceptions of users who had exceptions in place for each of
+    the two previous deletions are withdrawn, as the user_message warns,
+    leaving them only those listed as permanent in config.ini. Generations
+    with the same deletion date, eg. find run again, merged shards or a
+    rollback, count as one deletion, that of the last of them.
+    ~~~
+    $ sudo expirefiles.py diff /scratch
+    $ sudo expirefiles.py diff --enforce --check /scratch
+    ~~~
+
     Notify all users of the pending deletions
     This is the second phase of the script.
     ~~~
     $ sudo expirefiles.py notify /scratch
     ~~~
 
+    Emails are sent over a single SMTP connection at mail_rate messages per
+    minute, retrying temporary failures. Users already mailed about the last
+    find are recorded in *.expirefiles/notify.journal* and skipped if notify
+    is run again, eg. after the mail server failed part way.
+
+    The administrators' email shows the bytes to delete of each user and top
+    level directory, and histograms by age and size, all from the metadata
+    recorded by find. The same figures are written to
+    *.expirefiles/report.json*, and the files and bytes to delete of each
+    user by top level directory to *.expirefiles/report.csv*.
+    ~~~
+    $ sudo expirefiles.py notify --check /scratch
+    ~~~
+
     A user (in this case userx) lists all files they own that are scheduled 
     for deletion.
     ~~~
@@ -51,12 +118,60 @@
     userx$ expirefiles.py list --exception /scratch
     ~~~
 
+    Large lists can be narrowed to a directory or a minimum size, sorted
+    oldest or largest first and paged. A summary gives the number and size
+    of the files under each directory.
+    ~~~
+    userx$ expirefiles.py list --under /scratch/userx/run1 --sort size --limit 20 /scratch
+    userx$ expirefiles.py list --summary /scratch
+    ~~~
+
+    The directories holding a user's files to delete, with the number,
+    bytes and oldest and newest access times of those beneath each, two
+    levels deep. This is kept by find, so is shown without reading the file
+    list, and can not be narrowed by --min-size or show --exceptions. The
+    administrators' email also lists the directories directly holding the
+    most files to delete.
+    ~~~
+    userx$ expirefiles.py list --tree --depth 2 /scratch
+    ~~~
+
     Remove all files under /scratch that are candidates for deletion.
     This is the third and final phase of the script.
     ~~~
     $ sudo expirefiles.py remove /scratch
     ~~~
 
+    Files are removed by a pool of threads (default 8). The removal rate can be
+    limited to spare the metadata servers of a shared filesystem. Files that
+    can not be removed are listed in *.expirefiles/files_deleted.errors*, or
+    by remove --check in *.expirefiles/files_deleted.check.errors*.
+    ~~~
+    $ sudo expirefiles.py remove --workers 16 --max-rate 2000 /scratch
+    ~~~
+
+    Both find and remove can also slow down by themselves when the storage is
+    busy, here when the 99th percentile stat latency goes over 20ms. The
+    achieved and limited rates are shown in the progress lines on stderr.
+    ~~~
+    $ sudo expirefiles.py find --max-rate 20000 --latency-target 20 /scratch
+    ~~~
+
+    Every phase keeps its progress, counters, stat, unlink and smtp latency
+    histograms and errors by errno in *.expirefiles/status.json*, and its
+    progress lines on stderr show the time left, estimated from its last run.
+    If metrics_textfile is set in config.ini the same metrics are also written
+    there in the Prometheus text format, for the node_exporter textfile
+    collector.
+    ~~~
+    $ python -m json.tool /scratch/.expirefiles/status.json
+    ~~~
+
+    Sorting the candidates, when find builds its index, for remove and for
+    an unlimited sorted list, holds at most sort_memory bytes of them in
+    memory (default 256M) and spills the rest to sorted runs under
+    *.expirefiles/sort*, so very large filesystems need no more memory.
+
     config.ini example
     -------------------
     - this is the default config.ini file generated when the init option is run.
@@ -66,6 +181,10 @@
     last_access_days  = 60
     notify_days       = 14
     mail_server       = localhost
+    mail_rate         = 6
+    metrics_textfile  = /var/lib/node_exporter/textfile/scratch.prom
+    sort_memory       = 256M
+    generations       = 3
     admin_email       = root
     from_email        = admin@widgets.com
     from_name         = Support
@@ -80,6 +199,12 @@
        # don't delete dot files
        /.
 
+    permanent =
+       root
+       admin
+       /no-delete/
+       /.
+
     [messages]
     user_subject =
        IMPORTANT Your {DIR_PATH} files not accessed for %(last_access_days)s days will be deleted on {DELETE_DATE}
@@ -101,7 +226,6 @@ import sys
 import os
 import grp
 import re
-import subprocess
 import argparse
 import traceback
 import datetime
@@ -109,54 +233,1317 @@ import shutil
 import smtplib
 import pwd
 import time
+import stat
+import errno
+import struct
+import threading
+import Queue
+import collections
+import mmap
+import json
+import zlib
+import socket
+import bisect
+import csv
+import cStringIO
+import heapq
+import itertools
+import glob
+import tempfile
 
 from email.mime.text import MIMEText
 from ConfigParser import SafeConfigParser
 
+# unlinkat(2) removes a file relative to an open directory, avoiding a full
+# path lookup for every file. os.unlink in python 2 has no dir_fd, so libc
+# is called directly.
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc_unlinkat = _libc.unlinkat
+except (ImportError, OSError, AttributeError):
+    _libc_unlinkat = None
+
+# likewise a file is stat'ed relative to its directory by opening it with
+# openat(2) and O_PATH, which only looks the file up and never follows a
+# symbolic link, and fstat().
+# Older kernels ignore O_PATH and open the file, so O_NONBLOCK keeps that
+# from waiting on a fifo.
+O_PATH = getattr(os, 'O_PATH', 0o10000000)
+try:
+    _libc_openat = sys.platform.startswith('linux') and _libc.openat or None
+except (NameError, AttributeError):
+    _libc_openat = None
+
+# os.scandir (python 3.5+) or the scandir backport avoids an lstat() per
+# directory entry. Fall back to os.listdir() if neither is available.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 
 CONFIG_DIR_NAME      = '.expirefiles'
 CONFIG_FILE          = 'config.ini'
 CACHE_DIR_NAME       = 'USER_FILE_CACHE'
+CANDIDATE_INDEX      = 'candidates.idx'
+CLASSIFICATION       = 'classification.dat'
+ROLLUP               = 'rollup.dat'
+SCAN_SNAPSHOT        = 'scan_snapshot.dat'
+FIND_CHECKPOINT      = 'find.checkpoint'
+SHARD_DIR_NAME       = 'shards'
+SHARD_FILE           = 'shard.json'
+NOTIFY_JOURNAL       = 'notify.journal'
+REPORT_JSON          = 'report.json'
+REPORT_CSV           = 'report.csv'
+ACCOUNTS_SNAPSHOT    = 'accounts.json'
+STATUS_FILE          = 'status.json'
+SORT_DIR_NAME        = 'sort'
+GENERATIONS_DIR_NAME = 'generations'
+CURRENT_GENERATION   = 'current'
+WITHDRAWN_EXCEPTIONS = 'withdrawn.json'
+PARTIAL_SUFFIX       = '.partial'
 FILES_TO_DELETE      = 'files_to_delete.raw'
+FILES_TO_DELETE_RECORDS = 'files_to_delete.rec'
 FILES_DELETED        = 'files_deleted.txt'
 FILES_DELETED_CHECK  = 'files_deleted.check'
+FILES_DELETE_ERRORS  = 'files_deleted.errors'
+FILES_DELETE_CHECK_ERRORS = 'files_deleted.check.errors'
 
 SUPPORT_GROUP        = 'support'
 
-FIND_COMMAND         = '/usr/bin/find' 
-LS_COMMAND           = '/bin/ls'
-
-LINE_BUFFER          = 1024
 
-# user_file_counts record file positions
-UFC_USER_NAME    = 0
-UFC_USER_TYPE    = 1
-UFC_TOTAL_COUNT  = 2
-UFC_DELETE_COUNT = 3
-UFC_EXCEPT_COUNT = 4
+RECORD_BUFFER        = 1024 * 1024
+
+# files_to_delete.rec holds one record per candidate file, a fixed header of
+# uid, gid, size, atime, mtime, inode and path length followed by the path.
+RECORD_HEADER        = struct.Struct('<IIQqqQI')
+
+FileRecord = collections.namedtuple(
+                'FileRecord', 'path uid gid size atime mtime inode')
+
+# sorted runs of candidates spilled to disk while the index is built hold
+# a fixed header of uid, gid, size, atime, mtime, inode, excepted flag and
+# path length followed by the path.
+SORT_ENTRY           = struct.Struct('<IIQqqQBI')
+
+# scan_snapshot.dat holds one record per directory of the last find: a
+# header of mtime, oldest file access time, file count, path length and
+# subdirectory names length, followed by the path and the NUL separated
+# names of the subdirectories.
+SNAPSHOT_HEADER      = struct.Struct('<ddQII')
+
+SnapshotEntry = collections.namedtuple(
+                  'SnapshotEntry', 'mtime min_atime file_count subdirs')
+
+# a directory modified this many seconds before it was read may have
+# changed again without its mtime changing, on filesystems with coarse
+# timestamps, so is not trusted by the next incremental find.
+SNAPSHOT_MTIME_SLACK = 2
+
+# candidates.idx holds the candidate files of a scan ordered by uid and path:
+# a header, a uid index of (uid, first record, record count) entries, fixed
+# width metadata columns and front coded paths. A user's files are one
+# contiguous range of every column.
+INDEX_MAGIC          = 'EXPI'
+INDEX_VERSION        = 1
+INDEX_HEADER         = struct.Struct('<4sIQQQ')
+INDEX_UID_ENTRY      = struct.Struct('<IQQ')
+INDEX_PATH_ENTRY     = struct.Struct('<HH')
+INDEX_COLUMNS        = (('gid', 'I'), ('size', 'Q'), ('atime', 'q'),
+                        ('mtime', 'q'), ('inode', 'Q'), ('path_offset', 'Q'))
+
+# paths are stored in full every INDEX_RESTART records so that reading can
+# start part way through a user's range.
+INDEX_RESTART        = 64
+
+# number of records read from each column at a time.
+INDEX_BLOCK          = 65536
+
+# rollup.dat holds, for each uid, every directory with files of the uid to
+# delete beneath it. A line of json gives the classification the verdicts
+# were taken from and the entries of each uid, then
+# each entry is the lengths of the path prefix shared with the previous
+# entry and of the rest of the path, the number of files directly in the
+# directory, the number, bytes and oldest and newest access times of all
+# the files beneath it, followed by the rest of the path. A uid's entries
+# are in tree order, each directory before its subdirectories.
+ROLLUP_ENTRY         = struct.Struct('<HHQQQqq')
+
+RollupEntry = collections.namedtuple(
+                'RollupEntry', 'path files count size min_atime max_atime')
+
+# number of directories whose matcher state is remembered by PathMatcher.
+MATCHER_CACHE_SIZE   = 65536
+
+# below this number of path exceptions plain substring tests are faster
+# than running the automaton.
+MATCHER_MIN_PATTERNS = 32
+
+# user types, in the order they are listed to the administrators.
+USER_TYPES       = ('REAL', 'SYSTEM', 'DEPARTED')
+USER_TYPE_TITLES = ('Real Users', 'System Users', 'Departed Users')
+
+# classification per user totals record positions
+CT_TOTAL_COUNT   = 0
+CT_DELETE_COUNT  = 1
+CT_EXCEPT_COUNT  = 2
+CT_DELETE_BYTES  = 3
+CT_EXCEPT_BYTES  = 4
+CT_AGE_HISTOGRAM = 5
+CT_SIZE_HISTOGRAM = 6
+CT_DIRECTORIES   = 7
+
+# version of the classification.dat format, an older file is classified
+# again from scratch.
+CLASSIFICATION_VERSION = 3
+
+# lower bounds of the buckets of the histograms of files to delete, by
+# days since last access at the time of the find and by size.
+AGE_HISTOGRAM_DAYS   = (0, 90, 180, 365, 730)
+SIZE_HISTOGRAM_BYTES = (0, 1 << 20, 100 << 20, 1 << 30, 10 << 30)
+
+# number of top level directories listed in the administrators' email,
+# report.json has all of them.
+REPORT_DIRECTORIES   = 40
 
 # accounts are considered as system accounts below this UID on most
 # UNIX based systems.
 MAX_SYSTEM_UID       = 499
 
-# time to sleep between sending individual emails to prevent
-# any mail relay from blacklisting us.
-MAIL_DELAY_SECS      = 10 
+# seconds a snapshot of the passwd and group databases is used for before
+# they are read again.
+ACCOUNTS_TTL_SECS    = 6 * 3600
+
+# default number of emails sent per minute, to prevent any mail relay
+# from blacklisting us.
+MAIL_RATE            = 6
+
+# attempts made at sending an email that fails with a temporary error, and
+# the seconds waited after the first failure, doubled after each one.
+MAIL_RETRIES         = 4
+MAIL_RETRY_SECS      = 30
+
+# notify journal entry of the email to the administrators, a name no user
+# can have.
+ADMIN_JOURNAL_KEY    = ':admin'
   
 # for testing
 FIND_DEPTH           = 2 
 
+# number of threads walking the filesystem during the find phase.
+# stat() calls release the GIL, so on a parallel filesystem the scan
+# rate scales with the number of outstanding metadata requests.
+SCAN_WORKERS         = 16
+
+# number of threads removing files during the remove phase.
+REMOVE_WORKERS       = 8
+
+# largest number of files of one directory handed to a remove thread.
+REMOVE_BATCH         = 1000
+
+
+# seconds between progress reports written to stderr.
+PROGRESS_INTERVAL_SECS = 60
+
+# upper bounds, in seconds, of the buckets of the latency histograms of
+# stat, unlink and smtp calls.
+LATENCY_BUCKETS      = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                        0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+
+# seconds between checkpoints of a running find.
+CHECKPOINT_INTERVAL_SECS = 300
+
+# default number of generations of the candidate lists and index kept.
+GENERATIONS          = 3
+
+# default bytes of memory of the candidates held by a sort before they are
+# spilled to a run file, and the bytes a candidate takes besides its path.
+SORT_MEMORY          = 256 << 20
+SORT_ENTRY_MEMORY    = 256
+
+# most run files merged at once, fewer than the open file limit. Any more
+# are first merged into longer runs.
+SORT_MERGE_RUNS      = 64
+
+# read buffer of each run file being merged.
+SORT_RUN_BUFFER      = 64 * 1024
+
+# batches of matches waiting for the classifier thread of a find before the
+# scan workers are held up.
+PIPELINE_QUEUE_SIZE  = 256
+
+# a sharded find splits the tree between shards by a hash of the paths of
+# the directories this deep. Shallower directories are read by every shard,
+# but their files only reported by the first.
+SHARD_DEPTH          = 2
+
+# adaptive throttling: operations per latency percentile calculation, the
+# factors the rate is multiplied by when the latency is over or well under
+# the target, and the lowest rate it will back off to.
+THROTTLE_SAMPLES     = 1000
+THROTTLE_DECREASE    = 0.5
+THROTTLE_INCREASE    = 1.1
+THROTTLE_MIN_RATE    = 10
+
 
 class Config:
   last_access_days      = 60
   notify_days           = 14
   admin_email           = 'root'
   mail_server           = 'localhost'
+  mail_rate             = MAIL_RATE
   from_email            = 'admin@widgets.com'
   from_name             = 'Support'
   user_subject_template = ''
   user_message_template = ''
   test_email            = ''
+  metrics_textfile      = ''
+  sort_memory           = SORT_MEMORY
+  generations           = GENERATIONS
+  permanent_users       = None
+  permanent_paths       = []
+
+
+class PathMatcher(object):
+    """ Match paths against all path exceptions in a single pass.
+
+    The path exception snippets are compiled into an Aho-Corasick automaton,
+    flattened into a table of transitions, so every character of a path is
+    looked at once however many exceptions there are. Candidate files share
+    their directories, so the automaton state at the end of each directory
+    is cached and usually only the file name has to be scanned.
+    """
+
+    # transition into a state where an exception has been matched.
+    MATCHED = -1
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.cache = {}
+
+        # trie of the patterns.
+        goto = [{}]
+        accept = [False]
+        for pattern in self.patterns:
+            state = 0
+            for c in pattern:
+                if c not in goto[state]:
+                    goto.append({})
+                    accept.append(False)
+                    goto[state][c] = len(goto) - 1
+                state = goto[state][c]
+            accept[state] = True
+
+        # breadth first, fill in the failure transitions from the state of
+        # the longest proper suffix.
+        alphabet = set(''.join(self.patterns))
+        fail = [0] * len(goto)
+        self.delta = [None] * len(goto)
+        order = [0]
+        for state in order:
+            delta = {}
+            for c in alphabet:
+                if c in goto[state]:
+                    child = goto[state][c]
+                    if state:
+                        fail[child] = self.delta[fail[state]].get(c, 0)
+                    accept[child] = accept[child] or accept[fail[child]]
+                    order.append(child)
+                    delta[c] = child
+                elif state:
+                    delta[c] = self.delta[fail[state]].get(c, 0)
+            self.delta[state] = delta
+
+        for delta in self.delta:
+            for c, state in list(delta.items()):
+                if state == self.MATCHED:
+                    continue
+                if accept[state]:
+                    delta[c] = self.MATCHED
+                elif not state:
+                    del delta[c]
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def search(self, path):
+        """ Return True if any of the patterns occurs in path.
+        """
+        if len(self.patterns) < MATCHER_MIN_PATTERNS:
+            for pattern in self.patterns:
+                if pattern in path:
+                    return True
+            return False
+
+        head, sep, tail = path.rpartition('/')
+        if not sep:
+            return self._run(0, path) == self.MATCHED
+
+        state = self.cache.get(head)
+        if state is None:
+            state = self._run(0, head + sep)
+            if len(self.cache) >= MATCHER_CACHE_SIZE:
+                self.cache.clear()
+            self.cache[head] = state
+
+        if state == self.MATCHED:
+            return True
+        return self._run(state, tail) == self.MATCHED
+
+    def _run(self, state, text):
+        delta = self.delta
+        for c in text:
+            state = delta[state].get(c, 0)
+            if state == self.MATCHED:
+                break
+        return state
+
+
+class Throttle(object):
+    """ Token bucket limiting the rate of an operation shared by threads.
+
+    A rate of 0 means unlimited. If a latency target is given the rate
+    also adapts to the storage: callers record the latency of each
+    operation, and for every THROTTLE_SAMPLES operations the rate is halved
+    if the 99th percentile latency is over the target, and raised again,
+    up to the configured rate, once it is well under it.
+    """
+
+    def __init__(self, rate, latency_target=0):
+        self.max_rate = rate
+        self.rate = rate
+        self.latency_target = latency_target
+        self.burst = max(rate, 1)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+        self.samples = []
+        self.sample_start = time.time()
+        self.p99 = 0.0
+        self.count = 0
+        self.report_count = 0
+        self.report_time = time.time()
+
+    def wait(self):
+        """ Take a token, sleeping until one is available.
+        """
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            delay = -self.tokens / float(self.rate)
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def record(self, latency):
+        """ Record the latency in seconds of one operation.
+        """
+        with self.lock:
+            self.count += 1
+            if not self.latency_target:
+                return
+
+            self.samples.append(latency)
+            if len(self.samples) >= THROTTLE_SAMPLES:
+                self._adapt()
+
+    def _adapt(self):
+        now = time.time()
+        samples = sorted(self.samples)
+        self.p99 = samples[int(len(samples) * 0.99)]
+        observed_rate = len(samples) / max(now - self.sample_start, 0.001)
+        self.samples = []
+        self.sample_start = now
+
+        if self.p99 > self.latency_target:
+            # back off from the rate actually achieved, which may be well
+            # under the limit.
+            rate = min(self.rate or observed_rate, observed_rate)
+            self.rate = max(rate * THROTTLE_DECREASE, THROTTLE_MIN_RATE)
+        elif self.rate and self.p99 < self.latency_target / 2:
+            self.rate *= THROTTLE_INCREASE
+            if self.max_rate and self.rate >= self.max_rate:
+                self.rate = self.max_rate
+        self.burst = max(self.rate, 1)
+
+    def status(self):
+        """ Return the rate achieved since the last call, and the limits.
+        """
+        with self.lock:
+            now = time.time()
+            rate = (self.count - self.report_count) / \
+                       max(now - self.report_time, 0.001)
+            self.report_count = self.count
+            self.report_time = now
+
+        msg = '{0:.0f}/sec'.format(rate)
+        if self.latency_target:
+            if self.rate:
+                msg += ' limit {0:.0f}/sec of {1}'.format(
+                           self.rate, self.max_rate or 'unlimited')
+            msg += ' p99 {0:.2f}ms target {1:.2f}ms'.format(
+                       self.p99 * 1000, self.latency_target * 1000)
+        elif self.rate:
+            msg += ' limit {0:.0f}/sec'.format(self.rate)
+        return msg
+
+
+class Metrics(object):
+    """ Counters, latency histograms and errors by errno of the current
+    phase of a run, find, create, notify or remove.
+
+    Phases write a progress line to stderr with report() whenever due().
+    The metrics of the last run of every phase are kept in status.json and
+    written, if Config.metrics_textfile is set, for the node_exporter
+    textfile collector. The time left is estimated from 'total', the final
+    value expected of the counter 'unit', by default the value it had at
+    the end of the last run of the phase.
+    """
+
+    def __init__(self):
+        self.phase = None
+        self.lock = threading.Lock()
+
+    def start(self, phase, config_path, find_path, total=None,
+              unit='files', elapsed=0):
+        """ Start phase, elapsed seconds ago if it is resumed.
+        """
+        self.finish()
+        self.status_path = os.path.join(config_path, STATUS_FILE)
+        self.find_path = find_path
+        self.total = total
+        self.unit = unit
+        self.counters = collections.OrderedDict()
+        self.latencies = collections.OrderedDict()
+        self.local = threading.local()
+        self.errors = {}
+        self.start_time = time.time() - elapsed
+        self.last_report = time.time()
+
+        self.status = {'phases': {}}
+        if os.path.exists(self.status_path):
+            with open(self.status_path, 'rb') as f:
+                try:
+                    self.status = json.loads(f.readline())
+                except ValueError:
+                    pass
+        previous = self.status['phases'].get(phase)
+        if total is None and previous and previous['state'] == 'done':
+            self.total = previous['counters'].get(unit)
+
+        self.phase = phase
+        self.save('running')
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        with self.lock:
+            self.counters[name] = value
+
+    def observe(self, name, seconds):
+        """ Add an operation that took seconds to the histogram name.
+        Each thread adds to histograms of its own, summed when saved, so
+        that no lock is taken for every operation.
+        """
+        try:
+            histogram = self.local.latencies[name]
+        except (AttributeError, KeyError):
+            histogram = self._histogram(name)
+        histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+    def _histogram(self, name):
+        """ Return a new histogram name of the current thread.
+        """
+        histogram = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        with self.lock:
+            if not hasattr(self.local, 'latencies'):
+                self.local.latencies = {}
+            self.local.latencies[name] = histogram
+            self.latencies.setdefault(name, []).append(histogram)
+        return histogram
+
+    def error(self, code):
+        """ Count an error, named by code or, if it is an errno, by its
+        symbol, eg. EACCES.
+        """
+        if isinstance(code, int):
+            code = errno.errorcode.get(code, str(code))
+        with self.lock:
+            self.errors[code] = self.errors.get(code, 0) + 1
+
+    def due(self):
+        """ Return True if a progress line is due.
+        """
+        return self.phase is not None and \
+               time.time() - self.last_report >= PROGRESS_INTERVAL_SECS
+
+    def eta(self):
+        """ Return the seconds the phase is expected to take yet, or None
+        if there is nothing to tell from.
+        """
+        done = self.counters.get(self.unit, 0)
+        if not self.total or not done:
+            return None
+        return max(self.total - done, 0) * \
+               (time.time() - self.start_time) / float(done)
+
+    def report(self, message):
+        """ Write message as a progress line of the phase to stderr, and
+        save the metrics.
+        """
+        eta = self.eta()
+        if eta is not None:
+            message += ', {0} left'.format(format_duration(eta))
+        sys.stderr.write('{0}: {1}\n'.format(self.phase, message))
+        self.last_report = time.time()
+        self.save('running')
+
+    def finish(self, state='done'):
+        """ Save the final metrics of the phase, if one is running.
+        """
+        if self.phase is not None:
+            self.save(state)
+            self.phase = None
+
+    def save(self, state):
+        now = time.time()
+        with self.lock:
+            self.status['updated'] = now
+            self.status['phases'][self.phase] = {
+                'state': state,
+                'start': self.start_time,
+                'elapsed': now - self.start_time,
+                'eta': state == 'running' and self.eta() or None,
+                'total': self.total,
+                'unit': self.unit,
+                'counters': dict(self.counters),
+                'errors': dict(self.errors),
+                'latency': dict((name, {'bounds': list(LATENCY_BUCKETS),
+                                        'counts': [sum(counts) for counts in
+                                                      zip(*histograms)][:-1],
+                                        'sum': sum(histogram[-1] for histogram
+                                                       in histograms)})
+                                    for name, histograms
+                                        in self.latencies.items())}
+            status = json.dumps(self.status) + '\n'
+
+        write_file(self.status_path, status)
+        if Config.metrics_textfile:
+            write_file(Config.metrics_textfile,
+                       prometheus_text(self.status, self.find_path))
+
+
+metrics = Metrics()
+
+
+def prometheus_text(status, find_path):
+    """ Return the metrics of every phase in status in the Prometheus text
+    format, labelled with the path and phase.
+    """
+    families = collections.OrderedDict()
+
+    def add(family, kind, name, labels, value):
+        samples = families.setdefault(family, (kind, []))[1]
+        samples.append('{0}{{{1}}} {2}'.format(name, ','.join([
+            '{0}="{1}"'.format(label, str(label_value).replace('\\', '\\\\')
+                                .replace('"', '\\"').replace('\n', '\\n'))
+                for label, label_value in labels]), value))
+
+    for phase, p in sorted(status['phases'].items()):
+        labels = [('path', find_path), ('phase', phase)]
+        for name, value in (('running', int(p['state'] == 'running')),
+                            ('failed', int(p['state'] == 'failed')),
+                            ('start_time_seconds', p['start']),
+                            ('elapsed_seconds', p['elapsed']),
+                            ('eta_seconds', p['eta'])):
+            if value is not None:
+                family = 'expirefiles_phase_' + name
+                add(family, 'gauge', family, labels, value)
+        for name, value in sorted(p['counters'].items()):
+            family = 'expirefiles_' + name
+            add(family, 'gauge', family, labels, value)
+        for code, count in sorted(p['errors'].items()):
+            add('expirefiles_errors', 'gauge', 'expirefiles_errors',
+                labels + [('error', code)], count)
+        for name, histogram in sorted(p['latency'].items()):
+            family = 'expirefiles_{0}_latency_seconds'.format(name)
+            total = 0
+            for bound, count in zip(histogram['bounds'] + ['+Inf'],
+                                    histogram['counts']):
+                total += count
+                add(family, 'histogram', family + '_bucket',
+                    labels + [('le', bound)], total)
+            add(family, 'histogram', family + '_sum', labels,
+                histogram['sum'])
+            add(family, 'histogram', family + '_count', labels, total)
+
+    lines = []
+    for family, (kind, samples) in families.items():
+        lines.append('# TYPE {0} {1}'.format(family, kind))
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+def format_duration(secs):
+    """ Return secs as a short human readable string, eg. 2h05m
+    """
+    secs = int(secs)
+    if secs >= 3600:
+        return '{0}h{1:02d}m'.format(secs // 3600, secs % 3600 // 60)
+    if secs >= 60:
+        return '{0}m{1:02d}s'.format(secs // 60, secs % 60)
+    return '{0}s'.format(secs)
+
+
+class TreeScanner(object):
+    """ Walk a directory tree with a pool of worker threads.
+
+    Directories are shared between the workers through a single LIFO work
+    queue, so an idle worker always takes the most recently discovered
+    directory. This keeps the walk depth first and the queue short on
+    very wide trees. Regular files accessed at or before 'cutoff' are
+    passed in batches to 'emit' as (path, lstat result) tuples.
+
+    Given a ScanSnapshot the state of every directory is recorded in it,
+    and directories that have not changed since the snapshot was taken,
+    and whose files were all accessed after the cutoff, are not read at
+    all. Access times only move forward, so none of their files can be a
+    candidate; only their subdirectories are visited.
+
+    Given a shard (index, count) only that shard's part of the tree is
+    scanned, see in_shard().
+    """
+
+    def __init__(self, top, cutoff, workers=SCAN_WORKERS, exclude=(),
+                 throttle=None, snapshot=None, shard=None):
+        self.top = top
+        self.cutoff = cutoff
+        self.shard = shard
+        self.workers = max(1, workers)
+        self.exclude = set(exclude)
+        self.throttle = throttle or Throttle(0)
+        self.snapshot = snapshot
+
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.queue = Queue.LifoQueue()
+
+        # directories queued or being read.
+        self.pending = set()
+
+        self.dir_count = 0
+        self.skip_count = 0
+        self.file_count = 0
+        self.match_count = 0
+        self.error_count = 0
+        self.failure = None
+        self.elapsed = 0
+        self.start_time = time.time()
+
+    def run(self, emit, start=None, checkpoint=None):
+        """ Scan the tree, calling emit(matches) with the lock held.
+
+        The scan starts from the directories in 'start', by default the top
+        of the tree. Every CHECKPOINT_INTERVAL_SECS checkpoint(pending) is
+        called with the lock held and the directories still to be read.
+        Everything emitted so far covers all other directories.
+
+        The first exception of a worker other than an OSError reading a
+        directory, eg. from emit or the snapshot, stops the scan and is
+        raised once the workers have finished.
+        """
+        if start is None:
+            start = [self.top]
+        self.start_time = time.time() - self.elapsed
+        self.pending = set(start)
+        for dir_path in start:
+            self.queue.put(dir_path)
+
+        threads = []
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, args=(emit,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        last_checkpoint = time.time()
+        with self.lock:
+            while self.pending and not self.failure:
+                self.idle.wait(
+                    min(PROGRESS_INTERVAL_SECS, CHECKPOINT_INTERVAL_SECS))
+                if not self.pending or self.failure:
+                    break
+
+                now = time.time()
+                if metrics.due():
+                    self.report()
+                if checkpoint and \
+                   now - last_checkpoint >= CHECKPOINT_INTERVAL_SECS:
+                    checkpoint(list(self.pending))
+                    last_checkpoint = now
+
+        # the queue is last in first out, so after a failure the workers
+        # stop before the directories still queued.
+        for t in threads:
+            self.queue.put(None)
+        for t in threads:
+            t.join()
+
+        if self.failure:
+            raise self.failure[0], self.failure[1], self.failure[2]
+
+    def counts(self):
+        """ Return the progress counters, to be restored on resume.
+        """
+        return {'dirs': self.dir_count, 'skipped': self.skip_count,
+                'files': self.file_count, 'matches': self.match_count,
+                'errors': self.error_count,
+                'elapsed': time.time() - self.start_time}
+
+    def restore(self, counts):
+        self.dir_count = counts['dirs']
+        self.skip_count = counts['skipped']
+        self.file_count = counts['files']
+        self.match_count = counts['matches']
+        self.error_count = counts['errors']
+        self.elapsed = counts['elapsed']
+
+    def report(self):
+        """ Write a progress line to stderr.
+        """
+        elapsed = max(time.time() - self.start_time, 0.001)
+        for name, value in (('files', self.file_count),
+                            ('directories', self.dir_count),
+                            ('unchanged_directories', self.skip_count),
+                            ('candidates', self.match_count)):
+            metrics.set(name, value)
+        metrics.report(
+            '{0} files in {1} directories ({2} unchanged), '
+            '{3} candidates, {4:.0f} files/sec, stat {5}'.format(
+                self.file_count, self.dir_count, self.skip_count,
+                self.match_count, self.file_count / elapsed,
+                self.throttle.status()))
+
+    def _worker(self, emit):
+        while True:
+            dir_path = self.queue.get()
+            if dir_path is None:
+                return
+            if self.failure:
+                continue
+
+            try:
+                self._visit(dir_path, emit)
+            except Exception:
+                with self.lock:
+                    if self.failure is None:
+                        self.failure = sys.exc_info()
+                    self.idle.notify_all()
+
+    def _visit(self, dir_path, emit):
+        """ Scan dir_path, emit its matches and queue its subdirectories.
+        """
+        subdirs, matches, file_count, entry, skipped = \
+            [], [], 0, None, False
+        try:
+            (subdirs, matches, file_count,
+             entry, skipped) = self._scan_dir(dir_path)
+        except OSError, e:
+            sys.stderr.write(
+                'find: {0} - {1}\n'.format(dir_path, e.strerror))
+            metrics.error(e.errno)
+            with self.lock:
+                self.error_count += 1
+
+        with self.lock:
+            try:
+                if matches:
+                    emit(matches)
+                if entry is not None:
+                    self.snapshot.add(dir_path, entry)
+            finally:
+                self.dir_count += 1
+                self.skip_count += skipped
+                self.file_count += file_count
+                self.match_count += len(matches)
+                for subdir in subdirs:
+                    self.pending.add(subdir)
+                    self.queue.put(subdir)
+                self.pending.discard(dir_path)
+                if not self.pending:
+                    self.idle.notify_all()
+
+    def _scan_dir(self, dir_path):
+        """ Return the subdirectories, the matching files, the number of
+        regular files, the SnapshotEntry of dir_path and whether it was
+        skipped as unchanged.
+        """
+        dir_st = None
+        if self.snapshot is not None:
+            dir_st = self._stat(os.lstat, dir_path)
+            previous = self.snapshot.get(dir_path)
+            if previous is not None and \
+               previous.mtime == dir_st.st_mtime and \
+               previous.min_atime > self.cutoff:
+                subdirs = [os.path.join(dir_path, name)
+                               for name in previous.subdirs.split('\0')
+                                   if name]
+                return subdirs, [], 0, previous, True
+
+        subdirs = []
+        subdir_names = []
+        matches = []
+        file_count = 0
+        min_atime = float('inf')
+        for name, is_dir, st in self._entries(dir_path):
+            path = os.path.join(dir_path, name)
+            if is_dir:
+                if path not in self.exclude and \
+                   in_shard(self.top, path, True, self.shard):
+                    subdirs.append(path)
+                    subdir_names.append(name)
+            elif in_shard(self.top, path, False, self.shard):
+                file_count += 1
+                min_atime = min(min_atime, st.st_atime)
+                if st.st_atime <= self.cutoff:
+                    matches.append((path, st))
+
+        entry = None
+        if dir_st is not None:
+            mtime = dir_st.st_mtime
+            if mtime > time.time() - SNAPSHOT_MTIME_SLACK:
+                mtime = -1.0
+            entry = SnapshotEntry(
+                      mtime, min_atime, file_count, '\0'.join(subdir_names))
+
+        return subdirs, matches, file_count, entry, False
+
+    def _entries(self, dir_path):
+        """ Yield (name, is_dir, lstat) for the directories and regular
+        files in dir_path. Symbolic links are never followed and entries
+        that vanish during the scan are skipped.
+        """
+        if scandir is not None:
+            for entry in self._stat(lambda: list(scandir(dir_path))):
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        yield entry.name, True, None
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry.name, False, self._stat(
+                                                   entry.stat,
+                                                   follow_symlinks=False)
+                except OSError:
+                    continue
+        else:
+            for name in self._stat(os.listdir, dir_path):
+                try:
+                    st = self._stat(os.lstat, os.path.join(dir_path, name))
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    yield name, True, None
+                elif stat.S_ISREG(st.st_mode):
+                    yield name, False, st
+
+    def _stat(self, func, *args, **kwargs):
+        """ Call a metadata operation within the throttle.
+        """
+        self.throttle.wait()
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            latency = time.time() - start
+            self.throttle.record(latency)
+            metrics.observe('stat', latency)
+
+
+class ScanSnapshot(object):
+    """ The scan_snapshot.dat of the previous find, if incremental, and
+    the one being written by this find. The new snapshot replaces the
+    previous one when it is closed.
+    """
+
+    def __init__(self, snapshot_path, incremental=False, offset=None):
+        self.snapshot_path = snapshot_path
+        self.previous = {}
+        if incremental and os.path.exists(snapshot_path):
+            self.previous = dict(read_snapshot(snapshot_path))
+
+        self.tmp_path = snapshot_path + PARTIAL_SUFFIX
+        self.file = open_output(self.tmp_path, offset)
+
+    def get(self, dir_path):
+        """ Return the previous SnapshotEntry of dir_path or None.
+        """
+        return self.previous.get(dir_path)
+
+    def add(self, dir_path, entry):
+        self.file.write(SNAPSHOT_HEADER.pack(
+            entry.mtime, entry.min_atime, entry.file_count,
+            len(dir_path), len(entry.subdirs)) + dir_path + entry.subdirs)
+
+    def sync(self):
+        """ Flush the snapshot to disk and return its size.
+        """
+        return sync_output(self.file)
+
+    def close(self):
+        self.file.close()
+        os.rename(self.tmp_path, self.snapshot_path)
+
+    def cleanup(self):
+        self.file.close()
+
+
+def read_snapshot(snapshot_path):
+    """ Yield (path, SnapshotEntry) from a scan_snapshot.dat file.
+    """
+    header_size = SNAPSHOT_HEADER.size
+    with open(snapshot_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = 0
+            while pos + header_size <= size:
+                (mtime, min_atime, file_count,
+                 path_len, subdirs_len) = SNAPSHOT_HEADER.unpack_from(data, pos)
+                pos += header_size
+                path = data[pos:pos + path_len]
+                pos += path_len
+                subdirs = data[pos:pos + subdirs_len]
+                pos += subdirs_len
+                yield path, SnapshotEntry(
+                                mtime, min_atime, file_count, subdirs)
+        finally:
+            data.close()
+
+
+def in_shard(top, path, is_dir, shard):
+    """ Return True if the directory or file at path under top belongs to
+    shard (index, count). Directories at SHARD_DEPTH are assigned by a
+    hash of their path relative to top, and everything below them follows.
+    Files above SHARD_DEPTH belong to the first shard.
+    """
+    if shard is None:
+        return True
+
+    index, count = shard
+    parts = path[len(top):].strip('/').split('/')
+    if len(parts) <= SHARD_DEPTH and not is_dir:
+        return index == 0
+    if len(parts) < SHARD_DEPTH:
+        # directories above SHARD_DEPTH are read by every shard.
+        return True
+
+    key = '/'.join(parts[:SHARD_DEPTH])
+    return (zlib.crc32(key) & 0xffffffff) % count == index
+
+
+def candidate_entries(records, path_prefix, user_exceptions, path_exceptions):
+    """ Yield a (uid, path, gid, size, atime, mtime, inode, excepted) tuple
+    for each FileRecord, with path_prefix added to its path. The tuples
+    sort in the order of the candidate index.
+    """
+    user_exceptions = set(user_exceptions)
+    for r in records:
+        path = path_prefix + r.path
+        yield (r.uid, path, r.gid, r.size, r.atime, r.mtime, r.inode,
+               r.uid in user_exceptions or bool(path_exceptions.search(path)))
+
+
+class CandidateSorter(object):
+    """ Sort candidate_entries() tuples within a memory budget, by key(entry)
+    if a key is given, then by the entries themselves.
+
+    Entries are held in memory until they take about 'memory' bytes, then
+    sorted and spilled to a run file in a directory of this process under
+    sort_path. sorted() merges the runs, at most SORT_MERGE_RUNS at a time,
+    so neither memory nor open files grow with the number of candidates or
+    of their owners. The runs of a process on this host that died are
+    removed by the next sort of the same name; sort_path may be shared with
+    other hosts, whose process ids mean nothing here.
+    """
+
+    def __init__(self, sort_path, name, key=None, memory=None):
+        host = socket.gethostname()
+        self.sort_path = sort_path
+        self.run_prefix = '{0}.{1}.{2}.'.format(name, host, os.getpid())
+        self.run_path = None
+        self.key = key
+        self.memory = memory or Config.sort_memory
+        self.entries = []
+        self.entries_size = 0
+        self.runs = []
+        self.uids = set()
+        self.count = 0
+
+        host_prefix = '{0}.{1}.'.format(name, host)
+        for path in glob.glob(os.path.join(sort_path, host_prefix + '*')):
+            pid = os.path.basename(path)[len(host_prefix):].partition('.')[0]
+            if pid.isdigit() and not process_exists(int(pid)):
+                shutil.rmtree(path, True)
+
+    def add(self, entry):
+        self.entries.append(entry)
+        self.entries_size += SORT_ENTRY_MEMORY + len(entry[1])
+        self.uids.add(entry[0])
+        self.count += 1
+        if self.entries_size >= self.memory:
+            self._sort_entries()
+            self.runs.append(self._write_run(self.entries))
+            self.entries = []
+            self.entries_size = 0
+
+    def extend(self, entries):
+        for entry in entries:
+            self.add(entry)
+
+    def sorted(self):
+        """ Return an iterator of all the entries added, in order.
+        """
+        while len(self.runs) >= SORT_MERGE_RUNS:
+            runs = self.runs[:SORT_MERGE_RUNS]
+            self.runs = self.runs[SORT_MERGE_RUNS:] + \
+                        [self._write_run(self._merge(runs, []))]
+            for path in runs:
+                os.remove(path)
+
+        self._sort_entries()
+        if not self.runs:
+            return iter(self.entries)
+        return self._merge(self.runs, self.entries)
+
+    def _sort_entries(self):
+        if self.key:
+            key = self.key
+            self.entries.sort(key=lambda entry: (key(entry), entry))
+        else:
+            self.entries.sort()
+
+    def _merge(self, runs, entries):
+        """ Merge the run files runs and the sorted entries.
+        """
+        sources = [self._read_run(path) for path in runs] + [iter(entries)]
+        if not self.key:
+            return heapq.merge(*sources)
+
+        key = self.key
+        return (entry for entry_key, entry in heapq.merge(
+                    *[((key(entry), entry) for entry in source)
+                          for source in sources]))
+
+    def _write_run(self, entries):
+        if self.run_path is None:
+            self.run_path = tempfile.mkdtemp(prefix=self.run_prefix,
+                                             dir=self.sort_path)
+        path = os.path.join(self.run_path, 'run.{0}'.format(len(self.runs)))
+        while os.path.exists(path):
+            path += '.0'
+
+        pack = SORT_ENTRY.pack
+        with open(path, 'wb') as f:
+            chunk = []
+            for e in entries:
+                chunk.append(pack(e[0], e[2], e[3], e[4], e[5], e[6], e[7],
+                                  len(e[1])) + e[1])
+                if len(chunk) >= INDEX_BLOCK:
+                    f.write(''.join(chunk))
+                    chunk = []
+            f.write(''.join(chunk))
+        return path
+
+    def _read_run(self, path):
+        header_size = SORT_ENTRY.size
+        unpack = SORT_ENTRY.unpack
+        with open(path, 'rb', SORT_RUN_BUFFER) as f:
+            while True:
+                header = f.read(header_size)
+                if not header:
+                    return
+                (uid, gid, size, atime, mtime, inode, excepted,
+                 length) = unpack(header)
+                yield (uid, f.read(length), gid, size, atime, mtime, inode,
+                       bool(excepted))
+
+    def cleanup(self):
+        """ Remove any run files.
+        """
+        if self.run_path is not None:
+            shutil.rmtree(self.run_path, True)
+
+
+def sort_path(config_path):
+    """ Return the directory for the runs of a CandidateSorter, under the
+    configuration directory or, for users who can not write there, the
+    system's temporary directory.
+    """
+    path = os.path.join(config_path, SORT_DIR_NAME)
+    if not os.path.exists(path):
+        try:
+            os.mkdir(path)
+        except OSError:
+            pass
+    if os.access(path, os.W_OK):
+        return path
+    return tempfile.gettempdir()
+
+
+def process_exists(pid):
+    """ Return True if there is a process pid.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def record_entries(records):
+    """ Return candidate_entries() tuples of FileRecords of files to delete.
+    """
+    return ((r.uid, r.path, r.gid, r.size, r.atime, r.mtime, r.inode, False)
+                for r in records)
+
+
+class CandidatePipeline(object):
+    """ The stages of find after the scan, run in a thread of their own.
+
+    Scan workers put batches of matches on a bounded queue, and are held up
+    if the thread falls behind. The thread appends each batch to the
+    candidate lists and, unless it only writes the lists (candidates is
+    None), classifies the files as they arrive and adds them to the
+    CandidateSorter candidates, so that create_user_files can build the
+    index from them without reading the lists back.
+    """
+
+    def __init__(self, files, records, candidates=None, path_prefix='',
+                 user_exceptions=(), path_exceptions=None):
+        self.files = files
+        self.records = records
+        self.candidates = candidates
+        self.path_prefix = path_prefix
+        self.user_exceptions = user_exceptions
+        self.path_exceptions = path_exceptions
+        self.error = None
+        self.queue = Queue.Queue(PIPELINE_QUEUE_SIZE)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, matches):
+        """ Queue a batch of (path, lstat result) tuples.
+        """
+        self.queue.put(matches)
+
+    def add(self, records):
+        """ Keep FileRecords already in the candidate lists, those found
+        before a checkpoint.
+        """
+        if self.candidates is not None:
+            self.candidates.extend(candidate_entries(
+                records, self.path_prefix, self.user_exceptions,
+                self.path_exceptions))
+
+    def flush(self):
+        """ Wait until every batch queued has been written.
+        """
+        self.queue.join()
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def _run(self):
+        while True:
+            matches = self.queue.get()
+            try:
+                if matches is None:
+                    return
+                if self.error is None:
+                    self.files.write(''.join([path + '\0'
+                                                 for path, st in matches]))
+                    self.records.write(''.join([pack_record(path, st)
+                                                   for path, st in matches]))
+                    self.add(FileRecord(path, st.st_uid, st.st_gid,
+                                        st.st_size, int(st.st_atime),
+                                        int(st.st_mtime), st.st_ino)
+                                 for path, st in matches)
+            except Exception, e:
+                # raised in the main thread by flush() or close().
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+
+def open_output(path, offset=None):
+    """ Open an output file, new or, if offset is given, truncated to offset
+    to continue from a checkpoint.
+    """
+    if offset is None:
+        return open(path, 'wb')
+
+    if not os.path.exists(path) or os.path.getsize(path) < offset:
+        raise IOError(
+            '{0} is shorter than its checkpoint, run a new find'.format(path))
+    f = open(path, 'r+b')
+    f.truncate(offset)
+    f.seek(offset)
+    return f
+
+
+def sync_output(f):
+    """ Flush f to disk and return its size.
+    """
+    f.flush()
+    os.fsync(f.fileno())
+    return f.tell()
+
+
+def write_checkpoint(checkpoint_path, header, pending):
+    """ Write a find checkpoint, a line of json followed by the NUL
+    separated directories still to be read.
+    """
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(json.dumps(header) + '\n')
+        f.write('\0'.join(pending))
+        sync_output(f)
+    os.rename(tmp_path, checkpoint_path)
+
+
+def read_checkpoint(checkpoint_path):
+    """ Return the header and the pending directories of a find checkpoint.
+    """
+    with open(checkpoint_path, 'rb') as f:
+        header = json.loads(f.readline())
+        pending = [d for d in f.read().split('\0') if d]
+
+    return header, pending
 
 
 def find_files(args):
@@ -168,34 +1555,298 @@ def find_files(args):
      user_exceptions,
      path_exceptions) = load_configuration(args.dirname)
 
-    files_to_delete_path  = os.path.join(config_path, FILES_TO_DELETE)
+    # a shard keeps its lists, snapshot and checkpoint in its own directory
+    # until they are merged. Otherwise the lists are written to a new
+    # generation, only published once it is complete.
+    output_path = config_path
+    if args.shard:
+        output_path = shard_path(config_path, args.shard)
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+    build_path = output_path
+
+    checkpoint_path = os.path.join(output_path, FIND_CHECKPOINT)
+
+    # the candidate lists are written as .partial files and only replace
+    # those of the previous find once the scan is complete.
+    offsets = {'files': None, 'records': None, 'snapshot': None}
+    pending = None
+    counts = None
+    if args.resume:
+        if not os.path.exists(checkpoint_path):
+            sys.stderr.write('ERROR: there is no find to resume.\n')
+            sys.exit(1)
 
-    # make a backup of the previous list of files to delete.
-    backup_file_path = \
-      files_to_delete_path + '.' + datetime.datetime.now().strftime('%Y%m%d')
+        header, pending = read_checkpoint(checkpoint_path)
+        if header['find_path'] != find_path:
+            sys.stderr.write(
+                'ERROR: checkpoint is for {0}\n'.format(header['find_path']))
+            sys.exit(1)
 
-    if os.path.exists(files_to_delete_path):
-        # remove backup file if it exists.
-        if os.path.exists(backup_file_path):
-            os.remove(backup_file_path)
-        os.rename(files_to_delete_path, backup_file_path)
+        cutoff = header['cutoff']
+        incremental = header['incremental']
+        offsets = header['offsets']
+        counts = header['counts']
+        if not args.shard:
+            if not header.get('generation'):
+                sys.stderr.write('ERROR: the checkpoint is of an earlier '
+                                 'version, run find without --resume.\n')
+                sys.exit(1)
+            build_path = os.path.join(config_path, GENERATIONS_DIR_NAME,
+                                      header['generation'])
+    else:
+        # same test as 'find -atime +N': the age in whole days, with any
+        # fractional part ignored, must be greater than N.
+        cutoff = time.time() - (Config.last_access_days + 1) * 24 * 3600
+        incremental = args.incremental
+        if not args.shard:
+            build_path = new_generation(config_path)
+
+    files_to_delete_path  = os.path.join(build_path, FILES_TO_DELETE)
+    records_path = os.path.join(build_path, FILES_TO_DELETE_RECORDS)
+
+    metrics.start('find', output_path, find_path,
+                  elapsed=counts and counts['elapsed'] or 0)
+
+    # record the state of every directory, so the next find can skip
+    # those that have not changed.
+    snapshot = ScanSnapshot(os.path.join(output_path, SCAN_SNAPSHOT),
+                            incremental, offsets['snapshot'])
+
+    # never consider our own configuration and cache files.
+    throttle = Throttle(args.max_rate, args.latency_target / 1000.0)
+    scanner = TreeScanner(find_path, cutoff, args.workers,
+                          exclude=[config_path], throttle=throttle,
+                          snapshot=snapshot, shard=args.shard)
+    if counts:
+        scanner.restore(counts)
 
-    # '-maxdepth', '2', 
-    cmd_args = [FIND_COMMAND, find_path,  
-                '-atime', '+' + str(Config.last_access_days), 
-                '-type', 'f', 
-                '-fprint0', files_to_delete_path]
+    try:
+        with open_output(files_to_delete_path + PARTIAL_SUFFIX,
+                         offsets['files']) as f, \
+             open_output(records_path + PARTIAL_SUFFIX,
+                         offsets['records']) as r:
+            # a shard only writes its lists, the index is built on merge.
+            if args.shard:
+                pipeline = CandidatePipeline(f, r)
+            else:
+                pipeline = CandidatePipeline(
+                    f, r, CandidateSorter(sort_path(config_path), 'create'),
+                    args.prefix or '', user_exceptions, path_exceptions)
+            if offsets['records']:
+                pipeline.add(read_records(records_path + PARTIAL_SUFFIX))
+
+            def emit(matches):
+                pipeline.put(matches)
+
+            def checkpoint(pending):
+                pipeline.flush()
+                write_checkpoint(checkpoint_path, {
+                    'find_path': find_path,
+                    'generation': not args.shard and
+                                  os.path.basename(build_path) or None,
+                    'cutoff': cutoff,
+                    'incremental': incremental,
+                    'offsets': {'files': sync_output(f),
+                                'records': sync_output(r),
+                                'snapshot': snapshot.sync()},
+                    'counts': scanner.counts()}, pending)
+
+            scanner.run(emit, pending, checkpoint)
+            pipeline.close()
+        snapshot.close()
+    finally:
+        snapshot.cleanup()
 
-    error_code = subprocess.call(cmd_args)
-    if error_code:
-        sys.stderr.write('ERROR: no files found\n')
-        sys.exit(1)
+    scanner.report()
+    if scanner.error_count:
+        sys.stderr.write(
+            'WARNING: {0} directories could not be read\n'.format(
+                scanner.error_count))
+
+    if args.shard:
+        os.rename(records_path + PARTIAL_SUFFIX, records_path)
+        os.rename(files_to_delete_path + PARTIAL_SUFFIX, files_to_delete_path)
+        write_json_file(os.path.join(output_path, SHARD_FILE), {
+            'find_path': find_path,
+            'shard': list(args.shard),
+            'cutoff': cutoff,
+            'counts': scanner.counts()})
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        return
+
+    os.rename(records_path + PARTIAL_SUFFIX, records_path)
+    os.rename(files_to_delete_path + PARTIAL_SUFFIX, files_to_delete_path)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    create_user_files(args, build_path, pipeline.candidates)
+
+
+def shard_argument(value):
+    """ argparse type of --shard, 'I/N' for shard I (from 0) of N.
+    """
+    match = re.match(r'^(\d+)/(\d+)$', value)
+    if not match or int(match.group(1)) >= int(match.group(2)):
+        raise argparse.ArgumentTypeError(
+            "'{0}' is not a shard, expected I/N with 0 <= I < N".format(value))
+    return int(match.group(1)), int(match.group(2))
+
+
+def shard_path(config_path, shard):
+    """ Return the directory of the output of shard (index, count).
+    """
+    return os.path.join(config_path, SHARD_DIR_NAME,
+                        'shard-{0}-of-{1}'.format(*shard))
+
+
+def generation_path(config_path):
+    """ Return the directory of the current generation of the candidate
+    lists and index, or config_path for those of a find by an earlier
+    version. The link is read once, so a reader keeps to the generation it
+    started with when a newer one is published.
+    """
+    path = os.path.join(config_path, CURRENT_GENERATION)
+    if os.path.islink(path):
+        return os.path.join(config_path, os.readlink(path))
+    return config_path
+
+
+def list_generations(config_path):
+    """ Return the names of the published generations, oldest first.
+    """
+    generations_path = os.path.join(config_path, GENERATIONS_DIR_NAME)
+    if not os.path.exists(generations_path):
+        return []
+    return sorted((name for name in os.listdir(generations_path)
+                       if not name.endswith(PARTIAL_SUFFIX)),
+                  key=lambda name: map(int, re.findall(r'\d+', name)))
+
+
+def new_generation(config_path):
+    """ Create the directory of a new generation, named by the time, and
+    return it. Generations left unpublished by an earlier find, which can
+    no longer be resumed, are removed.
+    """
+    generations_path = os.path.join(config_path, GENERATIONS_DIR_NAME)
+    if not os.path.exists(generations_path):
+        os.mkdir(generations_path)
+    for name in os.listdir(generations_path):
+        if name.endswith(PARTIAL_SUFFIX):
+            shutil.rmtree(os.path.join(generations_path, name), True)
+
+    name = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(generations_path, name)
+    number = 0
+    while os.path.exists(path):
+        number += 1
+        path = os.path.join(generations_path, '{0}.{1}'.format(name, number))
+    os.mkdir(path + PARTIAL_SUFFIX)
+    return path + PARTIAL_SUFFIX
+
+
+def publish_generation(config_path, build_path):
+    """ Make the generation built in build_path current, and remove all
+    but the last Config.generations and the files of an earlier version.
+    """
+    path = build_path
+    if path.endswith(PARTIAL_SUFFIX):
+        path = path[:-len(PARTIAL_SUFFIX)]
+        os.rename(build_path, path)
+    set_current_generation(config_path, os.path.basename(path))
+
+    names = list_generations(config_path)
+    for name in names[:-Config.generations]:
+        if name != os.path.basename(path):
+            shutil.rmtree(os.path.join(config_path, GENERATIONS_DIR_NAME,
+                                       name), True)
+
+    for name in (CANDIDATE_INDEX, ROLLUP, CLASSIFICATION, FILES_TO_DELETE,
+                 FILES_TO_DELETE_RECORDS):
+        if os.path.exists(os.path.join(config_path, name)):
+            os.remove(os.path.join(config_path, name))
+    user_cache_path = os.path.join(config_path, CACHE_DIR_NAME)
+    if os.path.exists(user_cache_path):
+        shutil.rmtree(user_cache_path)
+
+
+def set_current_generation(config_path, name):
+    """ Point the current link at generation name, replacing it in one
+    rename so readers see either generation.
+    """
+    path = os.path.join(config_path, CURRENT_GENERATION)
+    if os.path.lexists(path + '.tmp'):
+        os.remove(path + '.tmp')
+    os.symlink(os.path.join(GENERATIONS_DIR_NAME, name), path + '.tmp')
+    os.rename(path + '.tmp', path)
+
+
+def write_json_file(json_file_path, header):
+    """ Replace json_file_path with a line of json of header.
+    """
+    write_file(json_file_path, json.dumps(header) + '\n')
+
+
+def write_file(file_path, data):
+    """ Replace file_path with data, so readers see the old or new file.
+    """
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        sync_output(f)
+    os.rename(tmp_path, file_path)
+
+
+def merge_shards(args):
+    """ combine the lists of all the shards of a sharded find into one,
+    as if found by a single find.
+    """
+    (config_path,
+     find_path,
+     user_exceptions,
+     path_exceptions) = load_configuration(args.dirname)
+
+    shard_paths = [shard_path(config_path, (i, args.shards))
+                       for i in range(args.shards)]
+    for path in shard_paths:
+        shard_file_path = os.path.join(path, SHARD_FILE)
+        if not os.path.exists(shard_file_path):
+            sys.stderr.write(
+                'ERROR: {0} has not completed a find.\n'.format(path))
+            sys.exit(1)
+        with open(shard_file_path, 'rb') as f:
+            header = json.loads(f.readline())
+        if header['find_path'] != find_path:
+            sys.stderr.write('ERROR: {0} is a find of {1}\n'.format(
+                path, header['find_path']))
+            sys.exit(1)
+
+    build_path = new_generation(config_path)
+    for name in (FILES_TO_DELETE, FILES_TO_DELETE_RECORDS):
+        with open(os.path.join(build_path, name), 'wb') as f:
+            for path in shard_paths:
+                with open(os.path.join(path, name), 'rb') as shard_file:
+                    shutil.copyfileobj(shard_file, f, RECORD_BUFFER)
+            sync_output(f)
+
+    create_user_files(args, build_path)
+
+    # the shard lists are only removed once the merged generation is
+    # published, so that a failed merge can be run again. The snapshots
+    # stay with each shard for its next incremental find.
+    for path in shard_paths:
+        for name in (SHARD_FILE, FILES_TO_DELETE, FILES_TO_DELETE_RECORDS):
+            os.remove(os.path.join(path, name))
 
-    create_user_files(args)
 
+def create_user_files(args, build_path, candidates=None):
+    """ create the candidate index, a list of files to be deleted grouped by
+    user, with its rollup and classification, in the generation build_path
+    and publish it.
 
-def create_user_files(args):
-    """ create a file for each user containing a list of files to be deleted.
+    candidates is the CandidateSorter of the classified candidate_entries()
+    collected by find, read from the candidate lists if not given.
     """
 
     (config_path, 
@@ -203,181 +1854,1254 @@ def create_user_files(args):
      user_exceptions,
      path_exceptions) = load_configuration(args.dirname)
 
-    files_to_delete_path  = os.path.join(config_path, FILES_TO_DELETE)
+    files_to_delete_path  = os.path.join(build_path, FILES_TO_DELETE)
     if not os.path.exists(files_to_delete_path):
         sys.stderr.write('ERROR: You must run find first.\n')
         sys.exit(1)
 
-    # remove old cache and create a new one.
-    user_cache_path = os.path.join(config_path, CACHE_DIR_NAME)
-    if os.path.exists(user_cache_path):
-        shutil.rmtree(user_cache_path)
-    os.mkdir(user_cache_path)
-
     path_prefix = ''
     if args.prefix:
         path_prefix =  args.prefix
 
-    file_handles = {}
+    index_path = os.path.join(build_path, CANDIDATE_INDEX)
+    metrics.start('create', config_path, find_path, unit='candidates')
+    read_lists = candidates is None
+    if read_lists:
+        candidates = CandidateSorter(sort_path(config_path), 'create')
     try:
-        for file_name in readlines(files_to_delete_path, LINE_BUFFER):
+        if read_lists:
+            candidates.extend(candidate_entries(
+                list_file_records(build_path), path_prefix,
+                user_exceptions, path_exceptions))
+        metrics.total = candidates.count
+
+        # the index, the classification of every candidate and the rollup
+        # of the files to delete, for notify, list and remove, are all
+        # written in one pass.
+        writer = CandidateIndexWriter(index_path, candidates.count,
+                                      len(candidates.uids))
+        rollup = RollupWriter(os.path.join(build_path, ROLLUP),
+                              path_prefix + find_path)
+        classification = Classification(
+            (), user_exceptions, path_exceptions,
+            bytearray((candidates.count + 7) // 8), {}, time.time())
+        try:
+            for i, entry in enumerate(candidates.sorted()):
+                record = FileRecord(entry[1], entry[0], *entry[2:7])
+                writer.add(record)
+                if not entry[7]:
+                    rollup.add(record)
+                classification.classify(i, record, entry[7], find_path)
+                if metrics.due():
+                    metrics.set('candidates', i)
+                    metrics.report('{0} of {1} candidates indexed'.format(
+                                       i, candidates.count))
+            writer.close()
+            classification.index_id = [writer.count,
+                                        os.path.getmtime(index_path)]
+            rollup.close(classification.verdict_id())
+        finally:
+            writer.cleanup()
+            rollup.cleanup()
+    finally:
+        candidates.cleanup()
+
+    classification.save(os.path.join(build_path, CLASSIFICATION))
+    metrics.set('candidates', candidates.count)
+    metrics.set('users', len(candidates.uids))
+
+    # readers switch to the new index, rollup and classification at once.
+    publish_generation(config_path, build_path)
+
+
+class CandidateIndexWriter(object):
+    """ Write a candidates.idx file from FileRecords added in (uid, path)
+    order. The index is only renamed into place once it is complete.
+
+    If the number of records and of uids are given each column is written
+    straight to its place in the index. Otherwise columns are buffered in
+    temporary files next to the index, and copied into it at the end.
+    """
 
-            if file_name and os.path.exists(file_name):
+    def __init__(self, index_path, count=None, uid_count=None):
+        self.index_path = index_path
+        self.tmp_path = index_path + '.tmp'
+        self.in_place = count is not None and uid_count is not None
+        if self.in_place:
+            self.expected = (count, uid_count)
+            self.column_paths = []
+            open(self.tmp_path, 'wb').close()
+            offset = INDEX_HEADER.size + uid_count * INDEX_UID_ENTRY.size
+            self.columns = []
+            for name, code in INDEX_COLUMNS + (('paths', ''),):
+                f = open(self.tmp_path, 'r+b')
+                f.seek(offset)
+                self.columns.append(f)
+                if code:
+                    offset += struct.calcsize(code) * count
+            self.paths = self.columns.pop()
+        else:
+            self.column_paths = [self.tmp_path + '.' + name
+                                     for name, code in INDEX_COLUMNS]
+            self.columns = [open(path, 'wb') for path in self.column_paths]
+            self.paths = open(self.tmp_path + '.paths', 'wb')
+        self.buffers = [[] for name in INDEX_COLUMNS]
+        self.paths_size = 0
+        self.last_path = ''
+        self.uid_index = []
+        self.count = 0
+
+    def add(self, record):
+        """ Append record to the index.
+        """
+        if not self.uid_index or self.uid_index[-1][0] != record.uid:
+            if self.uid_index and record.uid < self.uid_index[-1][0]:
+                raise ValueError('records are not ordered by uid')
+            self.uid_index.append([record.uid, self.count, 0])
+
+        user = self.uid_index[-1]
+        shared = 0
+        if (self.count - user[1]) % INDEX_RESTART:
+            shared = min(len(os.path.commonprefix([self.last_path, record.path])),
+                         0xffff)
+        suffix = record.path[shared:]
+        self.paths.write(INDEX_PATH_ENTRY.pack(shared, len(suffix)) + suffix)
+
+        for values, value in zip(self.buffers, (
+                record.gid, record.size, record.atime, record.mtime,
+                record.inode, self.paths_size)):
+            values.append(value)
+
+        self.paths_size += INDEX_PATH_ENTRY.size + len(suffix)
+        self.last_path = record.path
+        self.count += 1
+        user[2] += 1
+        if not self.count % INDEX_BLOCK:
+            self._flush()
+
+    def _flush(self):
+        for (name, code), f, values in zip(
+                INDEX_COLUMNS, self.columns, self.buffers):
+            f.write(struct.pack('<{0}{1}'.format(len(values), code), *values))
+            del values[:]
+
+    def close(self):
+        """ Write the header, assembling the index from the temporary files
+        if needed.
+        """
+        self._flush()
+        for f in self.columns + [self.paths]:
+            f.close()
+
+        if self.in_place and \
+           self.expected != (self.count, len(self.uid_index)):
+            raise ValueError('expected {0} records of {1} uids'.format(
+                                 *self.expected))
+
+        with open(self.tmp_path, self.in_place and 'r+b' or 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION,
+                        self.count, len(self.uid_index), self.paths_size))
+            f.write(''.join([INDEX_UID_ENTRY.pack(*user)
+                                for user in self.uid_index]))
+            for path in self.column_paths + (
+                    not self.in_place and [self.paths.name] or []):
+                with open(path, 'rb') as column:
+                    shutil.copyfileobj(column, f, RECORD_BUFFER)
+
+        os.rename(self.tmp_path, self.index_path)
+
+    def cleanup(self):
+        """ Remove any temporary files.
+        """
+        for f in self.columns + [self.paths]:
+            f.close()
+        for path in set(self.column_paths + [self.paths.name, self.tmp_path]):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class CandidateIndex(object):
+    """ Read only, mmap'ed view of a candidates.idx file.
+    """
+
+    def __init__(self, index_path):
+        self.file = open(index_path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.mtime = os.fstat(self.file.fileno()).st_mtime
+
+        (magic, version, self.count, uid_count,
+         paths_size) = INDEX_HEADER.unpack_from(self.data, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(
+                '{0} is not a candidate index'.format(index_path))
+
+        offset = INDEX_HEADER.size
+        self.users = collections.OrderedDict()
+        for i in range(uid_count):
+            uid, first, count = INDEX_UID_ENTRY.unpack_from(self.data, offset)
+            self.users[uid] = (first, count)
+            offset += INDEX_UID_ENTRY.size
+
+        self.column_offsets = {}
+        for name, code in INDEX_COLUMNS:
+            self.column_offsets[name] = (offset, code, struct.calcsize(code))
+            offset += struct.calcsize(code) * self.count
+        self.paths_offset = offset
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def uids(self):
+        """ Return the uids that own candidate files, in ascending order.
+        """
+        return list(self.users)
+
+    def user_count(self, uid):
+        """ Return the number of candidate files owned by uid.
+        """
+        return self.users.get(uid, (0, 0))[1]
+
+    def user_first(self, uid):
+        """ Return the position in the index of the first file of uid.
+        """
+        return self.users.get(uid, (0, 0))[0]
+
+    def column(self, name, first, count):
+        """ Return values first .. first + count - 1 of a column.
+        """
+        offset, code, size = self.column_offsets[name]
+        return struct.unpack_from(
+                 '<{0}{1}'.format(count, code), self.data, offset + first * size)
+
+    def records(self, uid, start=0, stop=None):
+        """ Yield the FileRecords of uid, optionally only those from
+        position start up to but not including stop within the user's range.
+        """
+        first, count = self.users.get(uid, (0, 0))
+        if stop is None or stop > count:
+            stop = count
+
+        # paths can only be decoded from a restart point.
+        pos = start - start % INDEX_RESTART
+        if pos >= stop:
+            return
+        data = self.data
+        path_pos = self.paths_offset + self.column('path_offset', first + pos, 1)[0]
+        path = ''
+        while pos < stop:
+            n = min(INDEX_BLOCK, stop - pos)
+            columns = zip(*[self.column(name, first + pos, n)
+                               for name, code in INDEX_COLUMNS[:-1]])
+            for gid, size, atime, mtime, inode in columns:
+                shared, length = INDEX_PATH_ENTRY.unpack_from(data, path_pos)
+                path_pos += INDEX_PATH_ENTRY.size
+                path = path[:shared] + data[path_pos:path_pos + length]
+                path_pos += length
+                if pos >= start:
+                    yield FileRecord(path, uid, gid, size, atime, mtime, inode)
+                pos += 1
+
+    def records_at(self, uid, positions):
+        """ Yield the FileRecords at the ascending positions within the range
+        of uid. Positions close together are decoded in one pass.
+        """
+        positions = list(positions)
+        while positions:
+            run = 1
+            while run < len(positions) and \
+                  positions[run] - positions[run - 1] < INDEX_RESTART:
+                run += 1
+            wanted = set(positions[:run])
+            for pos, record in enumerate(
+                    self.records(uid, positions[0], positions[run - 1] + 1),
+                    positions[0]):
+                if pos in wanted:
+                    yield record
+            positions = positions[run:]
+
+    def _restart_path(self, first, pos):
+        path_pos = self.paths_offset + \
+                   self.column('path_offset', first + pos, 1)[0]
+        shared, length = INDEX_PATH_ENTRY.unpack_from(self.data, path_pos)
+        path_pos += INDEX_PATH_ENTRY.size
+        return self.data[path_pos:path_pos + length]
+
+    def lower_bound(self, uid, path):
+        """ Return the position within the range of uid of the first file
+        whose path is not less than path.
+        """
+        first, count = self.users.get(uid, (0, 0))
+
+        # binary search the restart points, whose paths are stored whole,
+        # then decode the block before.
+        lo, hi = 0, (count + INDEX_RESTART - 1) // INDEX_RESTART
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._restart_path(first, mid * INDEX_RESTART) < path:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        pos = max(lo - 1, 0) * INDEX_RESTART
+        for record in self.records(uid, pos, min(lo * INDEX_RESTART, count)):
+            if record.path >= path:
+                break
+            pos += 1
+        return pos
+
+    def path_range(self, uid, dir_path):
+        """ Return the positions (start, stop) within the range of uid of
+        the files under dir_path.
+        """
+        prefix = dir_path.rstrip('/') + '/'
+        return (self.lower_bound(uid, prefix),
+                self.lower_bound(uid, prefix[:-1] + chr(ord('/') + 1)))
+
+    def all_records(self):
+        """ Yield the FileRecords of every user.
+        """
+        for uid in self.users:
+            for record in self.records(uid):
+                yield record
+
+
+def tree_order(path):
+    """ Sort key of directory paths putting each directory straight before
+    its subdirectories.
+    """
+    return path.replace('/', '\0')
 
-                userid = os.stat(file_name).st_uid
-                user_file_path = os.path.join(user_cache_path, str(userid))
 
-                if userid not in file_handles:
-                    file_handles[userid] = open(user_file_path, 'w')
+class RollupWriter(object):
+    """ Write a rollup.dat file from FileRecords added in (uid, path) order.
 
-                file_path = file_name
-                if path_prefix:
-                    file_path = path_prefix + file_name
-                file_handles[userid].write(file_path + '\0')
+    A directory's files are a contiguous run of a user's files, so a stack
+    of the directories from root down to that of the current file is
+    enough: a directory is complete when the first file outside it is added,
+    and its totals are then added to those of its parent.
+    """
+
+    def __init__(self, rollup_path, root):
+        self.rollup_path = rollup_path
+        self.tmp_path = rollup_path + '.tmp'
+        self.body = open(self.tmp_path + '.body', 'w+b')
+        self.root = root.rstrip('/')
+        self.users = {}
+        self.uid = None
+        self.stack = []
+        self.entries = []
+
+    def add(self, record):
+        """ Add record to the totals of its directory and those above it.
+        """
+        if record.uid != self.uid:
+            self._flush_user()
+            self.uid = record.uid
+
+        stack = self.stack
+        directory = record.path.rpartition('/')[0]
+        if not stack or directory != stack[-1][0]:
+            if directory != self.root and \
+               not directory.startswith(self.root + '/'):
+                return
+
+            while stack and directory != stack[-1][0] and \
+                  not directory.startswith(stack[-1][0] + '/'):
+                self._pop()
+            if not stack:
+                self._push(self.root)
+            top = stack[-1][0]
+            if directory != top:
+                for name in directory[len(top) + 1:].split('/'):
+                    self._push(stack[-1][0] + '/' + name)
+
+        entry = stack[-1]
+        entry[1] += 1
+        entry[2] += 1
+        entry[3] += record.size
+        entry[4] = min(entry[4], record.atime)
+        entry[5] = max(entry[5], record.atime)
+
+    def _push(self, path):
+        self.stack.append([path, 0, 0, 0, (1 << 63) - 1, -(1 << 63)])
+
+    def _pop(self):
+        entry = self.stack.pop()
+        if self.stack:
+            parent = self.stack[-1]
+            parent[2] += entry[2]
+            parent[3] += entry[3]
+            parent[4] = min(parent[4], entry[4])
+            parent[5] = max(parent[5], entry[5])
+        self.entries.append(entry)
+
+    def _flush_user(self):
+        while self.stack:
+            self._pop()
+        if not self.entries:
+            return
+
+        self.entries.sort(key=lambda entry: tree_order(entry[0]))
+        self.users[self.uid] = [self.body.tell(), len(self.entries)]
+        last_path = ''
+        for entry in self.entries:
+            path = entry[0]
+            shared = min(len(os.path.commonprefix([last_path, path])), 0xffff)
+            self.body.write(ROLLUP_ENTRY.pack(
+                shared, len(path) - shared, *entry[1:]) + path[shared:])
+            last_path = path
+        self.entries = []
+
+    def close(self, verdict_id):
+        """ Write the rollup of the files to delete by the classification
+        verdict_id.
+        """
+        self._flush_user()
+        with open(self.tmp_path, 'wb') as f:
+            f.write(json.dumps({
+                'classification': verdict_id,
+                'root': self.root,
+                'users': dict((str(uid), user)
+                                  for uid, user in self.users.items())}) + '\n')
+            self.body.seek(0)
+            shutil.copyfileobj(self.body, f, RECORD_BUFFER)
+        os.rename(self.tmp_path, self.rollup_path)
+
+    def cleanup(self):
+        self.body.close()
+        for path in (self.tmp_path, self.tmp_path + '.body'):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class Rollup(object):
+    """ Read only, mmap'ed view of a rollup.dat file.
+    """
+
+    def __init__(self, rollup_path):
+        self.file = open(rollup_path, 'rb')
+        header = json.loads(self.file.readline())
+        self.body_offset = self.file.tell()
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.verdict_id = header.get('classification')
+        self.root = str(header['root'])
+        self.users = dict((int(uid), tuple(user))
+                              for uid, user in header['users'].items())
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def entries(self, uid):
+        """ Yield the RollupEntries of uid in tree order.
+        """
+        offset, count = self.users.get(uid, (0, 0))
+        pos = self.body_offset + offset
+        path = ''
+        for i in range(count):
+            fields = ROLLUP_ENTRY.unpack_from(self.data, pos)
+            pos += ROLLUP_ENTRY.size
+            path = path[:fields[0]] + self.data[pos:pos + fields[1]]
+            pos += fields[1]
+            yield RollupEntry(path, *fields[2:])
+
+
+def open_rollup(data_path, index, classification):
+    """ Return the Rollup of the files of index to delete by classification,
+    or None if find has not built one.
+
+    If the saved rollup is of other verdicts, because the classification
+    changed but could not be saved, eg. by a user listing their files, a
+    private copy is built from index for this run.
+    """
+    rollup_path = os.path.join(data_path, ROLLUP)
+    if not os.path.exists(rollup_path):
+        return None
+
+    rollup = Rollup(rollup_path)
+    if rollup.verdict_id == classification.verdict_id():
+        return rollup
+    root = rollup.root
+    rollup.close()
+
+    fd, private_path = tempfile.mkstemp(prefix='expirefiles.rollup.')
+    os.close(fd)
+    try:
+        write_rollup(private_path, root, index, classification)
+        return Rollup(private_path)
     finally:
-        for file_handle in file_handles.values():
-            file_handle.close()
+        # the open Rollup keeps the file until it is closed.
+        os.remove(private_path)
+
+
+def update_rollup(data_path, index, classification):
+    """ Rebuild the rollup in the generation data_path, if any, from the
+    files of index to delete by classification.
+    """
+    rollup_path = os.path.join(data_path, ROLLUP)
+    if not os.path.exists(rollup_path):
+        return
 
+    rollup = Rollup(rollup_path)
+    root = rollup.root
+    current = rollup.verdict_id == classification.verdict_id()
+    rollup.close()
+    if not current:
+        write_rollup(rollup_path, root, index, classification)
 
-def readlines(filename, bufsize=1024, line_terminator='\0'):
+
+def write_rollup(rollup_path, root, index, classification):
+    """ Write the rollup of the files of index to delete by classification.
+    """
+    writer = RollupWriter(rollup_path, root)
+    try:
+        for uid in index.uids():
+            for i, record in enumerate(index.records(uid),
+                                       index.user_first(uid)):
+                if not classification.is_excepted(i):
+                    writer.add(record)
+        writer.close(classification.verdict_id())
+    finally:
+        writer.cleanup()
+
+
+def rollup_tree(rollup, uids, base, depth=None):
+    """ Yield (RollupEntry, level) of base and the directories below it to
+    depth levels, in tree order, totalled over uids.
+    """
+    base = base.rstrip('/')
+    directories = {}
+    for uid in uids:
+        for entry in rollup.entries(uid):
+            if entry.path != base and not entry.path.startswith(base + '/'):
+                continue
+            if depth is not None and \
+               entry.path[len(base):].count('/') > depth:
+                continue
+            total = directories.get(entry.path)
+            if total is None:
+                directories[entry.path] = list(entry)
+            else:
+                total[1] += entry.files
+                total[2] += entry.count
+                total[3] += entry.size
+                total[4] = min(total[4], entry.min_atime)
+                total[5] = max(total[5], entry.max_atime)
+
+    for path in sorted(directories, key=tree_order):
+        yield RollupEntry(*directories[path]), path[len(base):].count('/')
+
+
+def crowded_directories(rollup, uids, count):
+    """ Return [(directory, files)] of the count directories directly holding
+    the most candidate files of uids.
+    """
+    files = collections.defaultdict(int)
+    for uid in uids:
+        for entry in rollup.entries(uid):
+            if entry.files:
+                files[entry.path] += entry.files
+    return heapq.nlargest(count, files.items(), key=lambda item: item[1])
+
+
+def open_candidate_index(data_path):
+    """ Return the CandidateIndex of the last find, in the generation
+    data_path.
+    """
+    index_path = os.path.join(data_path, CANDIDATE_INDEX)
+    if not os.path.exists(index_path):
+        sys.stderr.write('ERROR: You must run find first.\n')
+        sys.exit(1)
+
+    return CandidateIndex(index_path)
+
+
+def pack_record(path, st):
+    """ Return the files_to_delete.rec record for path and its lstat result.
+    """
+    return RECORD_HEADER.pack(
+             st.st_uid, st.st_gid, st.st_size,
+             int(st.st_atime), int(st.st_mtime), st.st_ino, len(path)) + path
+
+
+def read_records(filename):
+    """ Read FileRecords from a files_to_delete.rec file.
+    A truncated record at the end of the file is ignored.
+    """
+
+    header_size = RECORD_HEADER.size
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            unpack_from = RECORD_HEADER.unpack_from
+            pos = 0
+            while pos + header_size <= size:
+                header = unpack_from(data, pos)
+                end = pos + header_size + header[-1]
+                if end > size:
+                    return
+                yield FileRecord(data[pos + header_size:end], *header[:-1])
+                pos = end
+        finally:
+            data.close()
+
+
+def list_file_records(data_path):
+    """ Return FileRecords for all candidate files found by the find of the
+    generation data_path. Candidate lists written before the metadata was
+    captured during the scan are stat'ed here instead.
+    """
+
+    records_path = os.path.join(data_path, FILES_TO_DELETE_RECORDS)
+    if os.path.exists(records_path):
+        return read_records(records_path)
+
+    return stat_file_records(os.path.join(data_path, FILES_TO_DELETE))
+
+
+def stat_file_records(files_to_delete_path):
+    """ Return FileRecords for the paths listed in files_to_delete_path
+    that still exist.
+    """
+    for file_name in readlines(files_to_delete_path):
+        try:
+            st = os.lstat(file_name)
+        except OSError:
+            continue
+        yield FileRecord(file_name, st.st_uid, st.st_gid, st.st_size,
+                         int(st.st_atime), int(st.st_mtime), st.st_ino)
+
+
+def readlines(filename, line_terminator='\0', bufsize=RECORD_BUFFER):
     """ Read terminated lines  from filename.
-    Default is null terminated lines.
+    Default is null terminated lines. The file is read in large blocks that
+    are split in one call, so only the partial last line of a block is
+    carried over to the next. An unterminated last line is ignored.
     """
 
-    buf = ''
-    with open(filename, 'r') as f:
+    with open(filename, 'rb') as f:
+        tail = ''
         data = f.read(bufsize)
         while data:
-            buf += data
-            lines = buf.split(line_terminator)
-            buf = lines.pop()
-            for line in lines: yield line
+            lines = (tail + data).split(line_terminator)
+            tail = lines.pop()
+            for line in lines:
+                yield line
             data = f.read(bufsize)
 
 
-def count_files_to_delete(file_list_path, user_exceptions, path_exceptions):
-    """ Return a count of the number of files to delete based on exceptions.
+def new_user_totals():
+    """ Return the empty classification totals of a user, see
+    Classification.
+    """
+    return [0, 0, 0, 0, 0,
+            [[0, 0] for edge in AGE_HISTOGRAM_DAYS],
+            [[0, 0] for edge in SIZE_HISTOGRAM_BYTES],
+            {}]
+
+
+class Classification(object):
+    """ The delete or except verdict of every file in a CandidateIndex and
+    per user totals. Bit i of 'bits' is set if file i is excepted and
+    'users' maps uids to [total count, delete count, except count,
+    delete bytes, except bytes, age histogram, size histogram, directories].
+    The histograms are [count, bytes] of the files to delete in each bucket
+    of AGE_HISTOGRAM_DAYS and SIZE_HISTOGRAM_BYTES, and directories maps
+    the top level directories of the user's files to delete to
+    [count, bytes].
+
+    The exceptions the verdicts were made with are kept, so that a change
+    to the configuration only needs the affected files reclassified. Ages
+    are counted back from 'time', when the index was built. The files of
+    the 'withdrawn' uids are only excepted by the permanent exceptions.
     """
-    return len(list(list_user_files_to_delete(
-                 file_list_path, user_exceptions, path_exceptions)))
 
-def list_all_files_to_delete(file_list_dir, user_exceptions, path_exceptions):
-    """ Return a count of the number of files to delete based on exceptions.
+    def __init__(self, index_id, user_exceptions, path_exceptions,
+                 bits, users, time, withdrawn=(), permanent_users=(),
+                 permanent_paths=()):
+        self.index_id = list(index_id)
+        self.user_exceptions = sorted(set(user_exceptions))
+        self.path_exceptions = sorted(set(path_exceptions))
+        self.withdrawn = sorted(set(withdrawn))
+        self.permanent_users = sorted(set(permanent_users))
+        self.permanent_paths = sorted(set(permanent_paths))
+        self.bits = bits
+        self.users = users
+        self.time = time
+        self.directory = (None, None)
+
+    def is_excepted(self, i):
+        return self.bits[i >> 3] & (1 << (i & 7))
+
+    def set_excepted(self, i, excepted):
+        if excepted:
+            self.bits[i >> 3] |= 1 << (i & 7)
+        else:
+            self.bits[i >> 3] &= ~(1 << (i & 7)) & 0xff
+
+    def user_totals(self, uid):
+        return self.users.get(uid) or new_user_totals()
+
+    def verdict_id(self):
+        """ Return the index and exceptions the verdicts were made with.
+        """
+        return json.dumps([self.index_id, self.user_exceptions,
+                           self.path_exceptions, self.withdrawn,
+                           self.permanent_users, self.permanent_paths])
+
+    def classify(self, i, record, excepted, find_path):
+        """ Set the verdict of file i of the index and add record to the
+        totals of its owner.
+        """
+        self.set_excepted(i, excepted)
+        totals = self.users.get(record.uid)
+        if totals is None:
+            totals = self.users[record.uid] = new_user_totals()
+
+        totals[CT_TOTAL_COUNT] += 1
+        if excepted:
+            totals[CT_EXCEPT_COUNT] += 1
+            totals[CT_EXCEPT_BYTES] += record.size
+            return
+
+        totals[CT_DELETE_COUNT] += 1
+        totals[CT_DELETE_BYTES] += record.size
+        for histogram, edges, value in (
+                (totals[CT_AGE_HISTOGRAM], AGE_HISTOGRAM_DAYS,
+                 max(self.time - record.atime, 0) // (24 * 3600)),
+                (totals[CT_SIZE_HISTOGRAM], SIZE_HISTOGRAM_BYTES, record.size)):
+            bucket = histogram[bisect.bisect_right(edges, value) - 1]
+            bucket[0] += 1
+            bucket[1] += record.size
+
+        # paths are bytes, but the totals are saved as json. Files of a
+        # directory come together, so remember the last one decoded.
+        directory = top_directory(record.path, find_path)
+        if directory != self.directory[0]:
+            self.directory = (directory, directory.decode('utf-8', 'replace'))
+        directories = totals[CT_DIRECTORIES]
+        if self.directory[1] not in directories:
+            directories[self.directory[1]] = [0, 0]
+        directories[self.directory[1]][0] += 1
+        directories[self.directory[1]][1] += record.size
+
+    def save(self, path):
+        """ Write the classification, a line of json followed by the bits.
+        """
+        header = json.dumps({
+            'version': CLASSIFICATION_VERSION,
+            'index': self.index_id,
+            'time': self.time,
+            'user_exceptions': self.user_exceptions,
+            'path_exceptions': self.path_exceptions,
+            'withdrawn': self.withdrawn,
+            'permanent_users': self.permanent_users,
+            'permanent_paths': self.permanent_paths,
+            'users': dict((str(uid), totals)
+                              for uid, totals in self.users.items())})
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(header + '\n')
+            f.write(self.bits)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """ Return the classification saved at path, or None if it was
+        saved by an older version.
+        """
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline())
+            if header.get('version') != CLASSIFICATION_VERSION:
+                return None
+            bits = bytearray(f.read())
+
+        return cls(header['index'],
+                   header['user_exceptions'],
+                   [str(e) for e in header['path_exceptions']],
+                   bits,
+                   dict((int(uid), totals)
+                            for uid, totals in header['users'].items()),
+                   header['time'],
+                   header.get('withdrawn', ()),
+                   header.get('permanent_users', ()),
+                   [str(e) for e in header.get('permanent_paths', ())])
+
+
+def top_directory(path, find_path):
+    """ Return the directory directly under find_path that path is in, or
+    find_path for a file directly under it.
+    """
+    start = path.find(find_path + '/')
+    if start == -1:
+        return find_path
+
+    start += len(find_path) + 1
+    end = path.find('/', start)
+    if end == -1:
+        return find_path
+    return path[:end]
+
+
+def classify_candidates(index, user_exceptions, path_exceptions, previous=None,
+                        find_path='', withdrawn=(), permanent_users=(),
+                        permanent_paths=()):
+    """ Return the Classification of every file in index.
+
+    If a previous classification of the same index is given only the files
+    whose verdict can have changed with the exceptions are looked at again.
+    The previous classification must have the same withdrawn uids, whose
+    files are only excepted by permanent_users and permanent_paths.
     """
-    for file in os.listdir(file_list_dir):
-        if not file.isdigit(): continue
 
-        user_file_path = os.path.join(file_list_dir, file)
-        for filename in list_user_files_to_delete(
-                user_file_path,
-                user_exceptions,
-                path_exceptions): yield filename
+    user_exceptions = set(user_exceptions)
+    withdrawn = set(withdrawn)
+    permanent = PathMatcher(permanent_paths)
+    added = removed = None
+    if previous is not None:
+        bits = bytearray(previous.bits)
+        users = dict((uid, list(totals))
+                         for uid, totals in previous.users.items())
+        added = PathMatcher(
+                  set(path_exceptions) - set(previous.path_exceptions))
+        removed = set(previous.path_exceptions) - set(path_exceptions)
+    else:
+        bits = bytearray((index.count + 7) // 8)
+        users = {}
+
+    classification = Classification(
+        (index.count, index.mtime), user_exceptions, path_exceptions,
+        bits, users, previous and previous.time or index.mtime,
+        withdrawn, permanent_users, permanent_paths)
+
+    for uid in index.uids():
+        if uid in withdrawn:
+            users.pop(uid, None)
+            user_excepted = uid in user_exceptions and uid in permanent_users
+            for i, record in enumerate(index.records(uid),
+                                       index.user_first(uid)):
+                classification.classify(
+                    i, record, user_excepted or permanent.search(record.path),
+                    find_path)
+            continue
 
-def list_user_files_to_delete(file_list_path, user_exceptions, path_exceptions):
-    """ Return a count of the number of files to delete based on exceptions.
+        user_excepted = uid in user_exceptions
+        was_user_excepted = False
+        if previous is not None:
+            was_user_excepted = uid in previous.user_exceptions
+            if user_excepted == was_user_excepted and \
+               (user_excepted or not (added or removed)):
+                continue
+
+        users.pop(uid, None)
+        first = index.user_first(uid)
+        for i, record in enumerate(index.records(uid), first):
+            if user_excepted:
+                excepted = True
+            elif previous is None or was_user_excepted:
+                excepted = path_exceptions.search(record.path)
+            elif previous.is_excepted(i):
+                # excepted by a path exception that may have been removed.
+                excepted = not removed or path_exceptions.search(record.path)
+            else:
+                # can only be excepted by a new path exception.
+                excepted = added.search(record.path)
+
+            classification.classify(i, record, excepted, find_path)
+
+    return classification
+
+
+def load_classification(data_path, index, user_exceptions, path_exceptions,
+                        find_path):
+    """ Return the Classification of index, in the generation data_path,
+    with the current exceptions, updating the saved classification if the
+    exceptions have changed.
     """
-    # check for user exception
-    useruid =  os.path.basename(file_list_path)
-    if int(useruid) in user_exceptions:
-       return
-    else:
-        # determine if the filepath is excepted.
-        for filename in readlines(file_list_path):
-            is_exception = [e for e in path_exceptions 
-                                if filename.find(e) != -1 ]
-            if not is_exception:
-                yield filename
 
+    classification_path = os.path.join(data_path, CLASSIFICATION)
+
+    # the exceptions withdrawn by diff --enforce, which leave only the
+    # permanent exceptions to those users.
+    withdrawn = []
+    permanent_users = permanent_paths = []
+    withdrawn_path = os.path.join(data_path, WITHDRAWN_EXCEPTIONS)
+    if os.path.exists(withdrawn_path):
+        with open(withdrawn_path, 'rb') as f:
+            withdrawn = json.loads(f.readline())['uids']
+        if withdrawn:
+            permanent_users = Config.permanent_users or []
+            permanent_paths = Config.permanent_paths
+
+    previous = None
+    if os.path.exists(classification_path):
+        previous = Classification.load(classification_path)
+        if previous is None or \
+           previous.index_id != [index.count, index.mtime] or \
+           previous.withdrawn != sorted(set(withdrawn)) or \
+           previous.permanent_users != sorted(set(permanent_users)) or \
+           previous.permanent_paths != sorted(set(permanent_paths)):
+            previous = None
+        elif previous.user_exceptions == sorted(set(user_exceptions)) and \
+             previous.path_exceptions == sorted(set(path_exceptions)):
+            return previous
+
+    classification = classify_candidates(
+                       index, user_exceptions, path_exceptions, previous,
+                       find_path, withdrawn, permanent_users, permanent_paths)
+    try:
+        classification.save(classification_path)
+        update_rollup(data_path, index, classification)
+    except (IOError, OSError):
+        # users listing their files can not update the classification, so
+        # it is used from memory and open_rollup() builds its own rollup.
+        pass
 
-def count_files_to_except(file_list_path, user_exceptions, path_exceptions):
-    """ Return a count of the number of files to except based on exceptions.
+    return classification
+
+
+def count_files_to_delete(classification, uid):
+    """ Return a count of the number of files to delete based on exceptions.
     """
-    return len(list(list_user_files_to_except(
-                 file_list_path, user_exceptions, path_exceptions)))
+    return classification.user_totals(uid)[CT_DELETE_COUNT]
 
-def list_all_files_to_except(file_list_dir, user_exceptions, path_exceptions):
-    """ Return a count of the number of files to except based on exceptions.
+def sort_by_directory(config_path, records):
+    """ Yield the paths of FileRecords ordered by directory, so that the
+    files of a directory owned by different users are removed as a batch.
     """
-    for file in os.listdir(file_list_dir):
-        if not file.isdigit(): continue
+    sorter = CandidateSorter(sort_path(config_path), 'remove',
+                             key=lambda entry: entry[1].rpartition('/')[0])
+    try:
+        sorter.extend(record_entries(records))
+        for entry in sorter.sorted():
+            yield entry[1]
+    finally:
+        sorter.cleanup()
 
-        user_file_path = os.path.join(file_list_dir, file)
-        for filename in list_user_files_to_except(
-                user_file_path,
-                user_exceptions,
-                path_exceptions): yield filename
+def list_user_files_to_delete(index, classification, uid):
+    """ Return the files of uid to delete based on exceptions.
+    """
+    if not count_files_to_delete(classification, uid):
+        return
 
+    for i, record in enumerate(index.records(uid), index.user_first(uid)):
+        if not classification.is_excepted(i):
+            yield record.path
 
-def list_user_files_to_except(file_list_path, user_exceptions, path_exceptions):
-    """ Return a count of the number of files excepted from deletion.
+
+def count_files_to_except(classification, uid):
+    """ Return a count of the number of files to except based on exceptions.
     """
+    return classification.user_totals(uid)[CT_EXCEPT_COUNT]
 
-    # check for user exception
-    useruid =  os.path.basename(file_list_path)
+def list_all_files_to_except(index, classification):
+    """ Return all files to except based on exceptions.
+    """
+    for uid in index.uids():
+        for filename in list_user_files_to_except(
+                index,
+                classification,
+                uid): yield filename
 
-    if int(useruid) in user_exceptions:
-        for filename in readlines(file_list_path):
-            yield filename
-    else:
-        # determine if the filepath is excepted.
-        for filename in readlines(file_list_path):
-            is_exception = [e for e in path_exceptions 
-                               if filename.find(e) != -1 ]
-            if is_exception:
-                yield filename
 
-def append_user_file_counts(
-        file_counts_list, file_list_path, user_exceptions, path_exceptions):
-    """Append user file counts to file_counts list
+def list_user_files_to_except(index, classification, uid):
+    """ Return the files of uid excepted from deletion.
+    """
+    if not count_files_to_except(classification, uid):
+        return
+
+    for i, record in enumerate(index.records(uid), index.user_first(uid)):
+        if classification.is_excepted(i):
+            yield record.path
+
+class Accounts(object):
+    """ User and group names of uids and gids, looked up once for all
+    commands.
+
+    Where passwd and group come from LDAP or SSSD each lookup can take a
+    round trip to a server. On first use all accounts are read at once with
+    getpwall() and getgrall(), or from a snapshot of them in the
+    .expirefiles directory younger than ACCOUNTS_TTL_SECS. Accounts that
+    are not enumerated, eg. with sssd enumerate = false, are looked up one
+    at a time, and both found and missing accounts are remembered and added
+    to the snapshot.
     """
 
-    exception_count = 0
-    total_count = 0
-    deletion_count = 0
-    user_type = ''
-
-    user_name = os.path.basename(file_list_path)
+    def __init__(self):
+        self.snapshot_path = None
+        self.snapshot_time = None
+        self.loaded = False
+        self.changed = False
+        self.users = {}
+        self.uids = {}
+        self.groups = {}
+        self.missing_uids = set()
+        self.missing_names = set()
+        self.missing_gids = set()
+
+    def load(self, snapshot_path=None):
+        """ Read all accounts, from snapshot_path if it is recent enough.
+        """
+        if self.loaded:
+            return
+        self.loaded = True
+        self.snapshot_path = snapshot_path
+
+        if snapshot_path and os.path.exists(snapshot_path):
+            try:
+                with open(snapshot_path, 'rb') as f:
+                    snapshot = json.load(f)
+                if 0 <= time.time() - snapshot['time'] < ACCOUNTS_TTL_SECS:
+                    for uid, name, gecos in snapshot['users']:
+                        self._add_user(uid, str(name), gecos.encode('utf-8'))
+                    for gid, name in snapshot['groups']:
+                        self.groups[gid] = str(name)
+                    self.missing_uids.update(snapshot['missing_uids'])
+                    self.missing_names.update(
+                        str(name) for name in snapshot['missing_names'])
+                    self.missing_gids.update(snapshot['missing_gids'])
+                    self.snapshot_time = snapshot['time']
+                    self.changed = False
+                    return
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+
+        for entry in pwd.getpwall():
+            self._add_user(entry.pw_uid, entry.pw_name, entry.pw_gecos)
+        for entry in grp.getgrall():
+            self.groups[entry.gr_gid] = entry.gr_name
+        self.snapshot_time = time.time()
+        self.changed = True
+
+    def _add_user(self, uid, name, gecos):
+        self.users[uid] = (name, gecos)
+        self.uids.setdefault(name, uid)
+
+    def _lookup_uid(self, uid):
+        if uid not in self.users and uid not in self.missing_uids:
+            try:
+                entry = pwd.getpwuid(uid)
+                self._add_user(entry.pw_uid, entry.pw_name, entry.pw_gecos)
+            except KeyError:
+                self.missing_uids.add(uid)
+            self.changed = True
+        return self.users.get(uid)
+
+    def user_name(self, uid):
+        """ Return the user name of uid, or None if there is no such user.
+        """
+        user = self._lookup_uid(uid)
+        return user and user[0]
+
+    def uid(self, user_name):
+        """ Return the uid of user_name, or None if there is no such user.
+        """
+        if user_name not in self.uids and user_name not in self.missing_names:
+            try:
+                entry = pwd.getpwnam(user_name)
+                self._add_user(entry.pw_uid, entry.pw_name, entry.pw_gecos)
+            except KeyError:
+                self.missing_names.add(user_name)
+            self.changed = True
+        return self.uids.get(user_name)
+
+    def gecos(self, user_name):
+        """ Return the gecos (full name) field of user_name.
+        """
+        user = self._lookup_uid(self.uid(user_name))
+        return user and user[1] or user_name
+
+    def group_name(self, gid):
+        """ Return the group name of gid, or None if there is no such group.
+        """
+        if gid not in self.groups and gid not in self.missing_gids:
+            try:
+                self.groups[gid] = grp.getgrgid(gid).gr_name
+            except KeyError:
+                self.missing_gids.add(gid)
+            self.changed = True
+        return self.groups.get(gid)
+
+    def user_type(self, uid):
+        """ Return 'REAL', 'SYSTEM', or 'DEPARTED' if uid no longer exists.
+        """
+        if self.user_name(uid) is None:
+            return 'DEPARTED'
+        elif uid < MAX_SYSTEM_UID:
+            return 'SYSTEM'
+        return 'REAL'
+
+    def save(self):
+        """ Update the snapshot with any accounts looked up since it was
+        read.
+        """
+        if not self.snapshot_path or not self.changed:
+            return
+
+        # accounts looked up since do not make the snapshot any younger.
+        snapshot = {
+            'time': self.snapshot_time,
+            'users': [[uid, name, gecos.decode('utf-8', 'replace')]
+                          for uid, (name, gecos) in self.users.items()],
+            'groups': self.groups.items(),
+            'missing_uids': list(self.missing_uids),
+            'missing_names': list(self.missing_names),
+            'missing_gids': list(self.missing_gids)}
+        tmp_path = self.snapshot_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                json.dump(snapshot, f)
+            os.rename(tmp_path, self.snapshot_path)
+            self.changed = False
+        except (IOError, OSError):
+            # users listing their files can not update the snapshot.
+            pass
+
+
+accounts = Accounts()
+
+
+def list_candidates(index, classification, uids, excepted=False, under=None,
+                    min_size=0, sort=None, offset=0, limit=None,
+                    spill_path=None):
+    """ Yield the FileRecords of the files of uids to delete, or if excepted
+    those excepted from deletion. Optionally only files under a directory,
+    of at least min_size bytes, sorted by 'atime' (oldest first) or 'size'
+    (largest first), and only limit files after skipping offset. All the
+    files are sorted with a CandidateSorter spilling to spill_path, if
+    given, rather than in memory.
+    """
+    ranges = []
+    for uid in uids:
+        first, count = index.users.get(uid, (0, 0))
+        start, stop = 0, count
+        if under:
+            start, stop = index.path_range(uid, under)
+        ranges.append((uid, first, start, stop))
+
+    if not sort:
+        for uid, first, start, stop in ranges:
+            for i, record in enumerate(
+                    index.records(uid, start, stop), first + start):
+                if bool(classification.is_excepted(i)) != excepted or \
+                   record.size < min_size:
+                    continue
+                if offset:
+                    offset -= 1
+                    continue
+                if limit is not None:
+                    if not limit:
+                        return
+                    limit -= 1
+                yield record
+        return
+
+    if limit is None and spill_path:
+        column = FileRecord._fields.index(sort)
+        sign = sort == 'size' and -1 or 1
+        sorter = CandidateSorter(spill_path, 'list',
+                                 key=lambda entry: sign * entry[column])
+        try:
+            sorter.extend(record_entries(list_candidates(
+                index, classification, uids, excepted, under, min_size)))
+            for entry in itertools.islice(sorter.sorted(), offset, None):
+                yield FileRecord(entry[1], entry[0], *entry[2:7])
+        finally:
+            sorter.cleanup()
+        return
+
+    # sort on the columns, and only decode the paths of the files listed.
+    sign = sort == 'size' and -1 or 1
+    def selected():
+        for uid, first, start, stop in ranges:
+            for block in range(start, stop, INDEX_BLOCK):
+                n = min(INDEX_BLOCK, stop - block)
+                keys = index.column(sort, first + block, n)
+                sizes = index.column('size', first + block, n)
+                for i, key, size in zip(
+                        range(first + block, first + block + n), keys, sizes):
+                    if bool(classification.is_excepted(i)) == excepted and \
+                       size >= min_size:
+                        yield sign * key, i, uid
+
+    if limit is None:
+        page = sorted(selected())[offset:]
+    else:
+        page = heapq.nsmallest(offset + limit, selected())[offset:]
 
-    assert user_name.isdigit()
-    user_uid  = int(user_name)
+    records = {}
+    for uid, first, start, stop in ranges:
+        positions = sorted(i - first for key, i, page_uid in page
+                               if page_uid == uid)
+        for pos, record in zip(positions, index.records_at(uid, positions)):
+            records[first + pos] = record
 
-    try:
-        user_name = pwd.getpwuid(user_uid).pw_name
-        if user_uid < MAX_SYSTEM_UID:
-            user_type = 'SYSTEM'
-        else:
-            user_type = 'REAL'
-    except KeyError:
-        user_type = 'DEPARTED'
+    for key, i, uid in page:
+        yield records[i]
 
-    for filename in readlines(file_list_path):
-        total_count += 1
-        if user_uid in user_exceptions:
-            exception_count += 1
-        else:
-            is_exception = [e for e in path_exceptions 
-                               if filename.find(e) != -1 ]
-            if is_exception:
-                exception_count += 1
-            else:
-                deletion_count += 1
 
-    assert total_count == exception_count + deletion_count
+def list_summary(index, classification, uids, find_path, excepted=False,
+                 under=None, min_size=0):
+    """ Return [(directory, count, bytes)] of the files that would be listed,
+    by the directory directly under the directory given, or find_path,
+    largest first.
+    """
+    directories = {}
+    if excepted or under or min_size:
+        for record in list_candidates(index, classification, uids, excepted,
+                                      under, min_size):
+            directory = directories.setdefault(
+                          top_directory(record.path, under or find_path),
+                          [0, 0])
+            directory[0] += 1
+            directory[1] += record.size
+    else:
+        # the totals of the files to delete were kept by classification.
+        for uid in uids:
+            totals = classification.user_totals(uid)
+            for name, (count, size) in totals[CT_DIRECTORIES].items():
+                directory = directories.setdefault(name.encode('utf-8'), [0, 0])
+                directory[0] += count
+                directory[1] += size
+
+    return sorted([(name, count, size)
+                       for name, (count, size) in directories.items()],
+                  key=lambda d: d[2], reverse=True)
+
+
+class UserCounts(object):
+    """ The counts of the candidate files of a user, kept for every owner
+    while notify reports and mails, so without an instance dictionary.
+    """
+    __slots__ = ('uid', 'name', 'type', 'total_count', 'delete_count',
+                 'except_count', 'delete_bytes', 'except_bytes')
 
-    file_counts_list.append(
-        (user_name, user_type, total_count, deletion_count, exception_count))
+    def __init__(self, uid, classification):
+        totals = classification.user_totals(uid)
+        self.uid = uid
+        self.name = accounts.user_name(uid) or str(uid)
+        self.type = accounts.user_type(uid)
+        self.total_count = totals[CT_TOTAL_COUNT]
+        self.delete_count = totals[CT_DELETE_COUNT]
+        self.except_count = totals[CT_EXCEPT_COUNT]
+        self.delete_bytes = totals[CT_DELETE_BYTES]
+        self.except_bytes = totals[CT_EXCEPT_BYTES]
 
 
 def check_user_exists(username):
     """check if the specified user exists and returns uid if user does.
     """
 
-    try:
-        user_uid = str(pwd.getpwnam(username).pw_uid)
-    except KeyError:
+    user_uid = accounts.uid(username)
+    if user_uid is None:
         return None
 
-    return user_uid
+    return str(user_uid)
 
 
 def calculate_deletion_date(filepath):
@@ -403,16 +3127,19 @@ def notify_users(args):
      user_exceptions,
      path_exceptions) = load_configuration(args.dirname)
 
-    file_counts_list = []
+    user_counts = []
 
 
-    files_to_delete_path  = os.path.join(config_path, FILES_TO_DELETE)
+    data_path = generation_path(config_path)
+    files_to_delete_path  = os.path.join(data_path, FILES_TO_DELETE)
     if not os.path.exists(files_to_delete_path):
         sys.stderr.write('ERROR: You must run find first.\n')
         sys.exit(1)
 
-    user_cache_path = os.path.join(config_path, CACHE_DIR_NAME)
-    assert os.path.exists(user_cache_path)
+    index = open_candidate_index(data_path)
+    classification = load_classification(
+                       data_path, index, user_exceptions, path_exceptions,
+                       find_path)
 
     deletion_date = calculate_deletion_date(files_to_delete_path)
     deletion_datestr =  deletion_date.strftime('%a %d %B %Y')
@@ -424,6 +3151,9 @@ def notify_users(args):
           format(deletion_datestr))
         sys.exit(0)
 
+    metrics.start(args.check and 'notify-check' or 'notify', config_path,
+                  find_path, unit='emails')
+
 
     # Notify one user
     if args.user:
@@ -433,130 +3163,423 @@ def notify_users(args):
                 'ERROR: invalid username -> ' + args.user + '\n' )
             sys.exit(1)
 
-        user_file_path = os.path.join(user_cache_path, user_uid)
-        if not os.path.exists(user_file_path):
+        if not index.user_count(int(user_uid)):
             print('User {0} has no files to delete\n'.format(args.user))
             sys.exit(0)
 
-        append_user_file_counts(
-            file_counts_list,
-            user_file_path,
-            user_exceptions,
-            path_exceptions)
+        user_counts.append(UserCounts(int(user_uid), classification))
 
     # Notify all users
     else:
-        for file in os.listdir(user_cache_path):
+        for user_uid in index.uids():
+            user_counts.append(UserCounts(user_uid, classification))
 
-            if not file.isdigit(): continue
 
-            user_file_path = os.path.join(user_cache_path, file)
-            append_user_file_counts(
-                file_counts_list,
-                user_file_path,
-                user_exceptions,
-                path_exceptions)
+    metrics.set('users', len(user_counts))
 
+    totals = report_totals(user_counts, classification)
+    crowded = None
+    rollup = open_rollup(data_path, index, classification)
+    if rollup:
+        crowded = crowded_directories(
+                    rollup, [user.uid for user in user_counts],
+                    REPORT_DIRECTORIES)
 
-    admin_msg = overall_usage_message(file_counts_list, deletion_datestr)
+    # the reports are of all users.
+    if not args.user:
+        write_reports(config_path, find_path, user_counts,
+                      deletion_datestr, classification, totals, crowded)
     
     if args.check:
-        print(admin_msg)
+        overall_usage_message(
+          sys.stdout, user_counts, deletion_datestr, totals, crowded)
+        sys.stdout.write('\n')
     else:
+        admin_msg = cStringIO.StringIO()
+        overall_usage_message(
+          admin_msg, user_counts, deletion_datestr, totals, crowded)
+
         subject = "{0} files cleanup scheduled for {1}".format(
                 args.dirname,  deletion_datestr)
-            
-        email_msg(Config.admin_email, subject, admin_msg)
-        for user in file_counts_list:
-            # only notify real users and if they have files that will be
-            # deleted.
-            if user[UFC_USER_TYPE] == 'REAL':
-                time.sleep(MAIL_DELAY_SECS)
-                user_command = __file__ + ' list ' + find_path
 
-                subject = \
-                    "IMPORTANT Your {0} files cleanup scheduled for {1}".format(
-                            args.dirname,  deletion_datestr)
+        # users already mailed about this find are skipped when all users
+        # are notified again, but not when one is named.
+        journal_path = None
+        if not args.user:
+            journal_path = os.path.join(config_path, NOTIFY_JOURNAL)
+
+        mailer = Mailer(Config.mail_server, Config.mail_rate, journal_path,
+                        os.path.getmtime(files_to_delete_path))
+        metrics.total = max(1 + len([user for user in user_counts
+                                        if user.type == 'REAL' and
+                                           user.delete_count]) -
+                            len(mailer.sent), 0)
+        try:
+            mailer.send(ADMIN_JOURNAL_KEY, Config.admin_email, subject,
+                        admin_msg.getvalue())
+            for user in user_counts:
+                # only notify real users and if they have files that will be
+                # deleted.
+                if user.type == 'REAL':
+                    user_command = __file__ + ' list ' + find_path
+
+                    subject = \
+                        "IMPORTANT Your {0} files cleanup scheduled for {1}".format(
+                                args.dirname,  deletion_datestr)
+
+                    subject = user_usage_subject(deletion_datestr, find_path)
+
+                    # only send an email if user has files that will be
+                    # deleted after exceptions applied.
+                    if user.delete_count: 
+                        message = user_usage_message(
+                                user, deletion_datestr, user_command, find_path)
+                        mailer.send(user.name, user.name, subject, message)
+
+                metrics.set('emails', mailer.sent_count)
+                if metrics.due():
+                    metrics.report('{0} emails sent, {1} failed'.format(
+                                       mailer.sent_count, mailer.error_count))
+        except MailerError, e:
+            sys.stderr.write('ERROR: {0}\n'.format(e))
+            sys.exit(1)
+        finally:
+            metrics.set('emails', mailer.sent_count)
+            mailer.close()
+
+        if mailer.error_count:
+            sys.stderr.write(
+                'ERROR: {0} emails could not be sent. Run notify again to '
+                'retry them.\n'.format(mailer.error_count))
+            sys.exit(1)
+
+
+class MailerError(Exception):
+    pass
 
-                subject = user_usage_subject(deletion_datestr, find_path)
 
-                # only send an email if user has files that will be deleted
-                # after exceptions applied.
-                if user[UFC_DELETE_COUNT]: 
-                    message = user_usage_message(
-                            user, deletion_datestr, user_command, find_path)
-                    email_msg(user[UFC_USER_NAME], subject, message)
+class Mailer(object):
+    """ Send emails over one SMTP connection, kept open between messages.
 
+    No more than rate emails are sent a minute. An email that fails with a
+    temporary error, a lost connection or a 4xx reply, is retried on a new
+    connection, waiting longer after each failure. Emails sent are recorded
+    in a journal for the find they are about (scan), so notify can be run
+    again after a failure without mailing anyone twice.
 
-def email_msg(user, subject, message):
-    """ Mail user a message with given subject.
+    mail_server can be host or host:port, so a local test server can be
+    used.
     """
 
-    msg = MIMEText(message)
+    def __init__(self, server, rate, journal_path=None, scan=None):
+        self.server = server
+        self.throttle = Throttle(rate / 60.0)
+        self.connection = None
+        self.sent_count = 0
+        self.error_count = 0
+        self.sent = set()
+        self.journal = None
+        if journal_path:
+            self._open_journal(journal_path, scan)
+
+    def _open_journal(self, journal_path, scan):
+        if os.path.exists(journal_path):
+            with open(journal_path, 'rb') as f:
+                header = json.loads(f.readline() or '{}')
+                if header.get('scan') == scan:
+                    self.sent.update(f.read().splitlines())
+
+        if self.sent:
+            self.journal = open(journal_path, 'ab')
+        else:
+            self.journal = open(journal_path, 'wb')
+            self.journal.write(json.dumps({'scan': scan}) + '\n')
+            sync_output(self.journal)
+
+    def send(self, key, user, subject, message):
+        """ Mail user a message with given subject, unless the email
+        recorded as key has already been sent. Return False if it could not
+        be sent.
+        """
+        if key in self.sent:
+            return True
+
+        # If in testing mode use TEST_EMAIL environment variable
+        if Config.test_email:
+            user = Config.test_email
+
+        msg = MIMEText(message)
+        msg['To'] = user
+        msg['From'] = Config.from_email
+        msg['subject'] = subject
+
+        self.throttle.wait()
+        delay = MAIL_RETRY_SECS
+        for attempt in range(MAIL_RETRIES):
+            start = time.time()
+            try:
+                if self.connection is None:
+                    self.connection = smtplib.SMTP(self.server)
+                self.connection.sendmail(
+                        Config.from_email,
+                        [user],
+                        msg.as_string())
+                metrics.observe('smtp', time.time() - start)
+                break
+            except (smtplib.SMTPException, socket.error), e:
+                metrics.observe('smtp', time.time() - start)
+                temporary = self._temporary(e)
+                if temporary:
+                    self._disconnect()
+                if not temporary or attempt == MAIL_RETRIES - 1:
+                    sys.stderr.write(
+                        'ERROR: could not mail {0}: {1}\n'.format(user, e))
+                    self.error_count += 1
+                    metrics.error(self._error_name(e))
+                    if temporary and \
+                       not isinstance(e, smtplib.SMTPRecipientsRefused):
+                        # the mail server is unavailable, stop rather than
+                        # retry every other email.
+                        raise MailerError(
+                            'mail server {0} is unavailable. Run notify again '
+                            'to continue.'.format(self.server))
+                    return False
+                time.sleep(delay)
+                delay *= 2
+
+        self.sent.add(key)
+        self.sent_count += 1
+        if self.journal:
+            self.journal.write(key + '\n')
+            sync_output(self.journal)
+        return True
+
+    @staticmethod
+    def _temporary(e):
+        """ Return True if the error e may go away if the email is sent
+        again.
+        """
+        if isinstance(e, smtplib.SMTPRecipientsRefused):
+            return all(400 <= code < 500
+                           for code, msg in e.recipients.values())
+        if isinstance(e, smtplib.SMTPResponseException):
+            return 400 <= e.smtp_code < 500
+        return isinstance(e, (smtplib.SMTPServerDisconnected, socket.error))
+
+    @staticmethod
+    def _error_name(e):
+        """ Return the SMTP reply code or errno of the error e.
+        """
+        if isinstance(e, smtplib.SMTPResponseException):
+            return 'SMTP{0}'.format(e.smtp_code)
+        if isinstance(e, socket.error) and e.errno:
+            return e.errno
+        return e.__class__.__name__
+
+    def _disconnect(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, socket.error):
+                self.connection.close()
+            self.connection = None
 
-    # If in testing mode use TEST_EMAIL environment variable
-    if Config.test_email:
-        user = Config.test_email
+    def close(self):
+        self._disconnect()
+        if self.journal:
+            self.journal.close()
 
 
-    msg['To'] = user
-    msg['From'] = Config.from_email
-    msg['subject'] = subject
-    server = smtplib.SMTP(Config.mail_server)
-    try:
-        server.sendmail(
-                Config.from_email,
-                [user],
-                msg.as_string())
-    finally:
-        server.quit()
+def format_bytes(size):
+    """ Return size in bytes as a short human readable string, eg. 1.5G
+    """
+    for unit in 'BKMGTP':
+        if size < 1024 or unit == 'P':
+            break
+        size /= 1024.0
+
+    if unit == 'B':
+        return '{0}B'.format(size)
+    return '{0:.1f}{1}'.format(size, unit)
+
+
+def histogram_labels():
+    """ Return the names of the buckets of the age and size histograms.
+    """
+    labels = []
+    for edges, label, unit in ((AGE_HISTOGRAM_DAYS, str, ' days'),
+                               (SIZE_HISTOGRAM_BYTES, format_bytes, '')):
+        names = ['{0}-{1}{2}'.format(label(low), label(high), unit)
+                     for low, high in zip(edges, edges[1:])]
+        names.append('{0}+{1}'.format(label(edges[-1]), unit))
+        labels.append(names)
+
+    return labels
 
 
-def overall_usage_message(file_counts_list, deletion_datestr):
-    """ Generate message for Administrators on usage counts.
+def report_totals(user_counts, classification):
+    """ Return the age histogram, the size histogram and the totals by top
+    level directory of the files to delete of the users in user_counts.
+    """
+    age_histogram = [[0, 0] for edge in AGE_HISTOGRAM_DAYS]
+    size_histogram = [[0, 0] for edge in SIZE_HISTOGRAM_BYTES]
+    directories = {}
+    for user in user_counts:
+        totals = classification.user_totals(user.uid)
+        for histogram, user_histogram in (
+                (age_histogram, totals[CT_AGE_HISTOGRAM]),
+                (size_histogram, totals[CT_SIZE_HISTOGRAM])):
+            for bucket, user_bucket in zip(histogram, user_histogram):
+                bucket[0] += user_bucket[0]
+                bucket[1] += user_bucket[1]
+        for directory, (count, size) in totals[CT_DIRECTORIES].items():
+            directory_totals = directories.setdefault(directory, [0, 0])
+            directory_totals[0] += count
+            directory_totals[1] += size
+
+    return age_histogram, size_histogram, directories
+
+
+def write_reports(config_path, find_path, user_counts,
+                  deletion_datestr, classification, totals, crowded=None):
+    """ Write the usage counts as report.json, and the files and bytes to
+    delete of each user by top level directory as report.csv
+
+    totals are the report_totals() of user_counts and crowded the
+    crowded_directories() of their rollup, if any. Each user is written
+    to report.json as it is encoded, on a line of its own, and without
+    sorting its keys, which would keep json from using its C encoder.
+    """
+    age_histogram, size_histogram, directories = totals
+    age_labels, size_labels = histogram_labels()
+
+    def histogram(buckets, labels):
+        return [{'bucket': label, 'count': count, 'bytes': size}
+                    for label, (count, size) in zip(labels, buckets)]
+
+    report = {
+        'find_path': find_path,
+        'deletion_date': deletion_datestr,
+        'last_access_days': Config.last_access_days,
+        'age_histogram': histogram(age_histogram, age_labels),
+        'size_histogram': histogram(size_histogram, size_labels),
+        'directories': dict(
+            (directory, {'count': count, 'bytes': size})
+                for directory, (count, size) in directories.items())}
+    if crowded is not None:
+        report['crowded_directories'] = [
+            {'directory': directory, 'files': files}
+                for directory, files in crowded]
+
+    report_path = os.path.join(config_path, REPORT_JSON)
+    with open(report_path + '.tmp', 'wb') as f:
+        f.write('{')
+        for key in sorted(report):
+            f.write('\n {0}: {1},'.format(
+                json.dumps(key), json.dumps(report[key], sort_keys=True)))
+        f.write('\n "users": [')
+        separator = '\n  '
+        for user in user_counts:
+            user_totals = classification.user_totals(user.uid)
+            f.write(separator + json.dumps({
+                'user': user.name,
+                'uid': user.uid,
+                'type': user.type,
+                'total_count': user.total_count,
+                'delete_count': user.delete_count,
+                'except_count': user.except_count,
+                'delete_bytes': user.delete_bytes,
+                'except_bytes': user.except_bytes,
+                'age_histogram': histogram(
+                    user_totals[CT_AGE_HISTOGRAM], age_labels),
+                'size_histogram': histogram(
+                    user_totals[CT_SIZE_HISTOGRAM], size_labels),
+                'directories': dict(
+                    (directory, {'count': count, 'bytes': size})
+                        for directory, (count, size)
+                            in user_totals[CT_DIRECTORIES].items())}))
+            separator = ',\n  '
+        f.write('\n ]\n}\n')
+    os.rename(report_path + '.tmp', report_path)
+
+    report_path = os.path.join(config_path, REPORT_CSV)
+    with open(report_path + '.tmp', 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['user', 'uid', 'type', 'directory',
+                         'delete_count', 'delete_bytes'])
+        for user in user_counts:
+            user_totals = classification.user_totals(user.uid)
+            for directory, (count, size) in sorted(
+                    user_totals[CT_DIRECTORIES].items()):
+                writer.writerow([user.name, user.uid, user.type,
+                                 directory.encode('utf-8'), count, size])
+    os.rename(report_path + '.tmp', report_path)
+
+
+def overall_usage_message(out, user_counts, deletion_datestr, totals,
+                          crowded=None):
+    """ Write the message for Administrators on usage counts to out.
+
+    totals are the report_totals() of user_counts and crowded the
+    crowded_directories() of their rollup, if any.
     """
 
-    msg = """
+    out.write("""
 Deletion is scheduled to occur on {1}.
 
 Counts of files that have not been accessed in {0} days.
 
-User, TotalFileCount DeleteFileCount ExceptedFileCount
-
-Real Users
-----------
-""".format(Config.last_access_days, deletion_datestr)
-
-    real_users = [ u for u in file_counts_list if u[UFC_USER_TYPE] == 'REAL' ]
-    for user in sorted(
-            real_users, key=lambda tup: tup[UFC_TOTAL_COUNT], reverse=True):
-        msg += '{0} {1} {2} {3}\n'.format(
-                user[UFC_USER_NAME],
-                user[UFC_TOTAL_COUNT],
-                user[UFC_DELETE_COUNT],
-                user[UFC_EXCEPT_COUNT])
-
-    msg += '\nSystem Users\n------------\n'
-    system_users = [ u for u in file_counts_list if u[UFC_USER_TYPE] == 'SYSTEM' ]
-    for user in sorted(
-            system_users, key=lambda tup: tup[UFC_TOTAL_COUNT], reverse=True):
-        msg += '{0} {1} {2} {3}\n'.format(
-                user[UFC_USER_NAME],
-                user[UFC_TOTAL_COUNT],
-                user[UFC_DELETE_COUNT],
-                user[UFC_EXCEPT_COUNT])
-
-    msg +=  "\nDeparted Users\n--------------\n"
-    departed_users = [ u for u in file_counts_list if u[UFC_USER_TYPE] == 'DEPARTED' ]
-    for user in sorted(
-            departed_users, key=lambda tup: tup[UFC_TOTAL_COUNT], reverse=True):
-        msg += '{0} {1} {2} {3}\n'.format(
-                user[UFC_USER_NAME],
-                user[UFC_TOTAL_COUNT],
-                user[UFC_DELETE_COUNT],
-                user[UFC_EXCEPT_COUNT])
-
-    return msg
+User, TotalFileCount DeleteFileCount ExceptedFileCount DeleteBytes
+""".format(Config.last_access_days, deletion_datestr))
+
+    # one sort lists the users by type, and by the most files within it.
+    users = sorted(user_counts, key=lambda user: (
+                       USER_TYPES.index(user.type), -user.total_count))
+    delete_count = delete_bytes = i = 0
+    for user_type, title in zip(USER_TYPES, USER_TYPE_TITLES):
+        out.write('\n{0}\n{1}\n'.format(title, '-' * len(title)))
+        while i < len(users) and users[i].type == user_type:
+            user = users[i]
+            out.write('{0} {1} {2} {3} {4}\n'.format(
+                    user.name,
+                    user.total_count,
+                    user.delete_count,
+                    user.except_count,
+                    format_bytes(user.delete_bytes)))
+            delete_count += user.delete_count
+            delete_bytes += user.delete_bytes
+            i += 1
+
+    age_histogram, size_histogram, directories = totals
+    age_labels, size_labels = histogram_labels()
+
+    out.write('\nTotal to delete\n---------------\n')
+    out.write('{0} files {1}\n'.format(
+            delete_count, format_bytes(delete_bytes)))
+
+    out.write('\nTo delete by top level directory\n')
+    out.write('--------------------------------\n')
+    for directory, (count, size) in heapq.nlargest(
+            REPORT_DIRECTORIES, directories.items(),
+            key=lambda item: item[1][1]):
+        out.write('{0} {1} {2}\n'.format(
+                directory.encode('utf-8'), count, format_bytes(size)))
+    if len(directories) > REPORT_DIRECTORIES:
+        out.write('... {0} more in {1}\n'.format(
+                len(directories) - REPORT_DIRECTORIES, REPORT_JSON))
+
+    for title, labels, histogram in (
+            ('To delete by days since last access', age_labels, age_histogram),
+            ('To delete by file size', size_labels, size_histogram)):
+        out.write('\n{0}\n{1}\n'.format(title, '-' * len(title)))
+        for label, (count, size) in zip(labels, histogram):
+            out.write('{0} {1} {2}\n'.format(label, count, format_bytes(size)))
+
+    if crowded is not None:
+        out.write('\nDirectories with the most candidate files\n')
+        out.write('-----------------------------------------\n')
+        for directory, files in crowded:
+            out.write('{0} {1}\n'.format(directory, files))
 
 
 def user_usage_subject(deletion_datestr, dir_path):
@@ -573,8 +3596,7 @@ def user_usage_message(user, deletion_datestr, user_command, dir_path):
     """Generate message specific for user.
     """
 
-    user_name = user[0]
-    user_gecos = pwd.getpwnam(user_name).pw_gecos
+    user_gecos = accounts.gecos(user.name)
     
     return Config.user_message_template.format(
            USERNAME=user_gecos,
@@ -583,41 +3605,277 @@ def user_usage_message(user, deletion_datestr, user_command, dir_path):
            COMMAND=user_command)
 
 
-def remove_file(filename, check=False, strip_path=''):
-    """Removes specified file but only if it exists
-    and the access time is greater than the Configured max access time.
-    Just print filname if in check mode
+def stat_at(dir_fd, name):
+    """ Return the lstat() result of name in the directory open as dir_fd.
     """
+    fd = _libc_openat(dir_fd, name, O_PATH | os.O_NOFOLLOW | os.O_NONBLOCK)
+    if fd == -1:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), name)
+    try:
+        return os.fstat(fd)
+    finally:
+        os.close(fd)
 
-    now_time = time.time()
 
-    if strip_path and filename.startswith(strip_path):
-        filename = filename[len(strip_path):]
+def unlink_at(dir_fd, name):
+    """ Remove name in the directory open as dir_fd.
+    """
+    if _libc_unlinkat(dir_fd, name, 0) == -1:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), name)
 
-    if not os.path.exists(filename):
-        return ''
-    else:
-        # recheck access time of file.
-        last_access_days =  (now_time - os.path.getatime(filename)) / 24 / 3600 
-        if last_access_days > Config.last_access_days:
-            if check:
-                # print last access time listing of file to be deleted.
-                cmd_args = [LS_COMMAND, '-lud', filename]
-                check = subprocess.check_output(cmd_args)
-                return check
 
-            else:
-                try:
-                    cmd_args = [LS_COMMAND, '-lud', filename]
-                    check = subprocess.check_output(cmd_args)
+def mode_string(mode):
+    """ Return the 'ls -l' style string of a file mode, eg. -rw-r--r--
+    """
+    chars = [{stat.S_IFDIR: 'd', stat.S_IFLNK: 'l', stat.S_IFCHR: 'c',
+              stat.S_IFBLK: 'b', stat.S_IFIFO: 'p', stat.S_IFSOCK: 's'}.get(
+                  stat.S_IFMT(mode), '-')]
+
+    for read, write, execute, special, set_char in (
+            (stat.S_IRUSR, stat.S_IWUSR, stat.S_IXUSR, stat.S_ISUID, 's'),
+            (stat.S_IRGRP, stat.S_IWGRP, stat.S_IXGRP, stat.S_ISGID, 's'),
+            (stat.S_IROTH, stat.S_IWOTH, stat.S_IXOTH, stat.S_ISVTX, 't')):
+        chars.append(mode & read and 'r' or '-')
+        chars.append(mode & write and 'w' or '-')
+        if mode & special:
+            chars.append(mode & execute and set_char or set_char.upper())
+        else:
+            chars.append(mode & execute and 'x' or '-')
+
+    return ''.join(chars)
+
+
+def owner_name(uid, gid):
+    """ Return (user name, group name) of uid and gid, or the numbers
+    if they do not resolve.
+    """
+    return (accounts.user_name(uid) or str(uid),
+            accounts.group_name(gid) or str(gid))
 
-                    os.remove(filename)
-                    return check
 
+def ls_line(path, st, now_time):
+    """ Return an 'ls -lud' style line, showing the last access time,
+    for path from its lstat result.
+    """
+
+    # like ls, show the year instead of the time for dates over six
+    # months away.
+    if abs(now_time - st.st_atime) < 183 * 24 * 3600:
+        date_format = '%b %e %H:%M'
+    else:
+        date_format = '%b %e  %Y'
+
+    user_name, group_name = owner_name(st.st_uid, st.st_gid)
+    return '{0} {1} {2} {3} {4} {5} {6}\n'.format(
+             mode_string(st.st_mode), st.st_nlink, user_name, group_name,
+             st.st_size, time.strftime(date_format, time.localtime(st.st_atime)),
+             path)
+
+
+class FileRemover(object):
+    """ Remove files with a pool of worker threads.
+
+    Files are handed to the workers in batches of one directory, each file
+    is rechecked with lstat and only removed if it is still a regular file
+    that has not been accessed in Config.last_access_days. The directory
+    of a batch is opened once and, where the platform allows, its files
+    are stat'ed and unlinked relative to it, so that only their names are
+    looked up rather than their full paths. An 'ls -lud'
+    style audit line is written to 'output' for every file removed (or
+    that would be removed in check mode) and failures are written to
+    'errors' without stopping the run.
+    """
+
+    def __init__(self, check=False, workers=REMOVE_WORKERS, max_rate=0,
+                 strip_path='', latency_target=0):
+        self.check = check
+        self.workers = max(1, workers)
+        self.throttle = Throttle(max_rate, latency_target)
+        self.strip_path = strip_path
+        self.stat_at = bool(_libc_openat)
+        self.unlink_at = not check and bool(_libc_unlinkat)
+
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue(self.workers * 4)
+        self.now_time = time.time()
+
+        self.file_count = 0
+        self.delete_count = 0
+        self.byte_count = 0
+        self.error_count = 0
+        self.failure = None
+        self.start_time = time.time()
+
+    def run(self, filenames, output, errors):
+        """ Remove filenames, which are expected to be ordered by directory.
+        The first exception of a worker, eg. writing to a full filesystem,
+        stops the run and is raised once the workers have finished.
+        """
+        self.start_time = self.now_time = time.time()
+
+        threads = []
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, args=(output, errors))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        for dir_path, names in self._batches(filenames):
+            if self.failure:
+                break
+            self.queue.put((dir_path, names))
+            if metrics.due():
+                self.report()
+
+        for t in threads:
+            self.queue.put(None)
+        for t in threads:
+            t.join()
+
+        if self.failure:
+            raise self.failure[0], self.failure[1], self.failure[2]
+
+    def report(self):
+        """ Write a progress line to stderr.
+        """
+        elapsed = max(time.time() - self.start_time, 0.001)
+        with self.lock:
+            metrics.set('files', self.file_count)
+            metrics.set('deleted', self.delete_count)
+            metrics.set('deleted_bytes', self.byte_count)
+        metrics.report(
+            '{0} files checked, {1} {2} ({3}), {4} errors, '
+            '{5:.0f} files/sec, {6} {7}'.format(
+                self.file_count, self.delete_count,
+                self.check and 'to delete' or 'deleted',
+                format_bytes(self.byte_count),
+                self.error_count, self.file_count / elapsed,
+                self.check and 'stat' or 'unlink', self.throttle.status()))
+
+    def _batches(self, filenames):
+        """ Group consecutive files of the same directory.
+        """
+        dir_path = None
+        names = []
+        for filename in filenames:
+            if self.strip_path and filename.startswith(self.strip_path):
+                filename = filename[len(self.strip_path):]
+
+            head, name = os.path.split(filename)
+            if head != dir_path or len(names) >= REMOVE_BATCH:
+                if names:
+                    yield dir_path, names
+                dir_path = head
+                names = []
+            names.append(name)
+
+        if names:
+            yield dir_path, names
+
+    def _worker(self, output, errors):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            # after a failure the rest of the queue is only drained, so
+            # that run() is not left blocked on a full queue.
+            if self.failure:
+                continue
+            dir_path, names = batch
+
+            lines = []
+            failures = []
+            size = 0
+            try:
+                try:
+                    size = self._remove_batch(dir_path, names, lines,
+                                              failures)
+                finally:
+                    with self.lock:
+                        self.file_count += len(names)
+                        self.delete_count += len(lines)
+                        self.byte_count += size
+                        self.error_count += len(failures)
+                        output.write(''.join(lines))
+                        errors.write(''.join(failures))
+            except Exception:
+                with self.lock:
+                    if self.failure is None:
+                        self.failure = sys.exc_info()
+
+    def _remove_batch(self, dir_path, names, lines, failures):
+        """ Remove names in dir_path and return the bytes they held.
+        """
+        size = 0
+        dir_fd = None
+        if self.stat_at or self.unlink_at:
+            try:
+                dir_fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    return size
+                failures.extend(['ERROR: {0} - {1}\n'.format(
+                                     os.path.join(dir_path, name), e.strerror)
+                                     for name in names])
+                for name in names:
+                    metrics.error(e.errno)
+                return size
+
+        try:
+            for name in names:
+                path = os.path.join(dir_path, name)
+                try:
+                    if self.check:
+                        self.throttle.wait()
+                    start = time.time()
+                    if self.stat_at:
+                        st = stat_at(dir_fd, name)
+                    else:
+                        st = os.lstat(path)
+                    latency = time.time() - start
+                    metrics.observe('stat', latency)
                 except OSError, e:
-                    sys.stderr.write(
-                        'ERROR: {0} - {1}\n'.format(e.filename, e.strerror))
-                    sys.exit(1)
+                    # a symbolic link, if O_PATH is not supported.
+                    if e.errno not in (errno.ENOENT, errno.ELOOP):
+                        failures.append(
+                            'ERROR: {0} - {1}\n'.format(path, e.strerror))
+                        metrics.error(e.errno)
+                    continue
+
+                # recheck access time of file.
+                last_access_days = \
+                    (self.now_time - st.st_atime) / 24 / 3600
+                if not stat.S_ISREG(st.st_mode) or \
+                   last_access_days <= Config.last_access_days:
+                    continue
+
+                line = ls_line(path, st, self.now_time)
+                if not self.check:
+                    self.throttle.wait()
+                    try:
+                        start = time.time()
+                        if self.unlink_at:
+                            unlink_at(dir_fd, name)
+                        else:
+                            os.remove(path)
+                        metrics.observe('unlink', time.time() - start)
+                        latency = max(latency, time.time() - start)
+                    except OSError, e:
+                        failures.append(
+                            'ERROR: {0} - {1}\n'.format(path, e.strerror))
+                        metrics.error(e.errno)
+                        continue
+
+                self.throttle.record(latency)
+
+                lines.append(line)
+                size += st.st_size
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+        return size
 
 
 def remove_files(args):
@@ -639,36 +3897,49 @@ def remove_files(args):
     if not args.check:
         files_deleted_path  = os.path.join(config_path, FILES_DELETED)
 
-        # make a backup of the previous files deleted list
+        # make a backup of the previous files deleted list, a further one
+        # for each run on the same day.
         backup_file_path = \
           files_deleted_path + '.' + datetime.datetime.now().strftime('%Y%m%d')
+        number = 0
+        while os.path.exists(backup_file_path):
+            number += 1
+            backup_file_path = '{0}.{1}.{2}'.format(
+                files_deleted_path,
+                datetime.datetime.now().strftime('%Y%m%d'), number)
 
         if os.path.exists(files_deleted_path):
-            # remove backup file if it exists.
-            if os.path.exists(backup_file_path):
-                os.remove(backup_file_path)
             os.rename(files_deleted_path, backup_file_path)
 
 
-    user_cache_path = os.path.join(config_path, CACHE_DIR_NAME)
-    assert os.path.exists(user_cache_path)
+    data_path = generation_path(config_path)
+    index = open_candidate_index(data_path)
+    classification = load_classification(
+                       data_path, index, user_exceptions, path_exceptions,
+                       find_path)
+
+    remover = FileRemover(args.check, args.workers, args.max_rate,
+                          path_prefix, args.latency_target / 1000.0)
+    metrics.start(args.check and 'remove-check' or 'remove', config_path,
+                  find_path)
 
-    delete_count = 0
+    # a check has its own list of errors, as it has its own audit, so it
+    # leaves that of the last removal alone.
+    files_errors_path = os.path.join(config_path, FILES_DELETE_CHECK_ERRORS)
+    if not args.check:
+        files_errors_path = os.path.join(config_path, FILES_DELETE_ERRORS)
 
     # remove files for all users if no user option specified.
     if not args.user:
 
-        # keep an audit of deleted files.
-        with open(files_deleted_path, 'w') as f:
-            for filename in list_all_files_to_delete(
-                    user_cache_path,
-                    user_exceptions,
-                    path_exceptions):
-                deleted = remove_file(filename, args.check, path_prefix)
-                # keep audit of deleted file name and last access time of that file.
-                if deleted:
-                    delete_count += 1
-                    f.write(deleted)
+        # keep an audit of deleted files and their last access time, and
+        # of the files that could not be deleted.
+        metrics.total = sum(classification.user_totals(uid)[CT_DELETE_COUNT]
+                                for uid in index.uids())
+        with open(files_deleted_path, 'w') as f, \
+             open(files_errors_path, 'w') as errors:
+            remover.run(sort_by_directory(config_path, list_candidates(
+                index, classification, index.uids())), f, errors)
 
     # or, for specific user (NOTE: no audit of deleted files is kept in this case).
     # The audit is written to stdout.
@@ -679,21 +3950,245 @@ def remove_files(args):
                 'ERROR: invalid username -> ' + args.user + '\n' )
             sys.exit(1)
 
-        user_file_path = os.path.join(user_cache_path, user_uid)
-        for filename in list_user_files_to_delete(
-                user_file_path,
-                user_exceptions,
-                path_exceptions): 
-            deleted = remove_file(filename, args.check, path_prefix)
-            if deleted:
-                delete_count += 1
-                print(deleted)
+        metrics.total = count_files_to_delete(classification, int(user_uid))
+        remover.run(
+            list_user_files_to_delete(index, classification, int(user_uid)),
+            sys.stdout, sys.stderr)
 
+    remover.report()
+    delete_count = remover.delete_count
     if args.check:
         print('{0} files will be deleted. See {1}\n'.format(delete_count, files_deleted_path))
     else:
         print('{0} files were deleted. See {1}\n'.format(delete_count, files_deleted_path))
 
+    if remover.error_count:
+        sys.stderr.write('ERROR: {0} files could not be deleted.{1}\n'.format(
+            remover.error_count,
+            not args.user and ' See ' + files_errors_path or ''))
+        sys.exit(1)
+
+
+def show_generations(args):
+    """ List the generations kept, oldest first, with their number of
+    candidate files and of owners. The current one is marked with a '*'.
+    """
+    (config_path,
+     find_path,
+     user_exceptions,
+     path_exceptions) = load_configuration(args.dirname)
+
+    current = generation_path(config_path)
+    for name in list_generations(config_path):
+        path = os.path.join(config_path, GENERATIONS_DIR_NAME, name)
+        index = CandidateIndex(os.path.join(path, CANDIDATE_INDEX))
+        print('{0} {1} {2} files {3} users'.format(
+            path == current and '*' or ' ', name, index.count,
+            len(index.users)))
+        index.close()
+
+
+def rollback_generation(args):
+    """ Make the generation before the current one, or args.generation,
+    current again.
+    """
+    (config_path,
+     find_path,
+     user_exceptions,
+     path_exceptions) = load_configuration(args.dirname)
+
+    names = list_generations(config_path)
+    current = os.path.basename(generation_path(config_path))
+    if not names:
+        sys.stderr.write('ERROR: You must run find first.\n')
+        sys.exit(1)
+    if args.generation:
+        if args.generation not in names:
+            sys.stderr.write(
+                'ERROR: there is no generation {0}\n'.format(args.generation))
+            sys.exit(1)
+        name = args.generation
+    else:
+        earlier = current in names and names[:names.index(current)] or []
+        if not earlier:
+            sys.stderr.write(
+                'ERROR: there is no generation before {0}\n'.format(current))
+            sys.exit(1)
+        name = earlier[-1]
+
+    set_current_generation(config_path, name)
+    print('{0} is the current generation'.format(name))
+
+
+def generation_diff(old_index, new_index):
+    """ Yield (uid, [added count, added bytes, removed count, removed bytes,
+    persisting count, persisting bytes]) for each owner of candidate files
+    in either index, by merging their files in the (uid, path) order of the
+    indexes, so only one file of each is held at a time.
+    """
+    for uid in sorted(set(old_index.uids()) | set(new_index.uids())):
+        counts = [0, 0, 0, 0, 0, 0]
+        old_records = old_index.records(uid)
+        new_records = new_index.records(uid)
+        old = next(old_records, None)
+        new = next(new_records, None)
+        while old is not None or new is not None:
+            if new is None or (old is not None and old.path < new.path):
+                counts[2] += 1
+                counts[3] += old.size
+                old = next(old_records, None)
+            elif old is None or new.path < old.path:
+                counts[0] += 1
+                counts[1] += new.size
+                new = next(new_records, None)
+            else:
+                counts[4] += 1
+                counts[5] += new.size
+                old = next(old_records, None)
+                new = next(new_records, None)
+        yield uid, counts
+
+
+def exception_users(index, classification):
+    """ Return the uids with files excepted in classification by other than
+    the permanent exceptions.
+    """
+    permanent_users = set(Config.permanent_users or ())
+    permanent = PathMatcher(Config.permanent_paths)
+    uids = set()
+    for uid in index.uids():
+        if uid in permanent_users or \
+           not classification.user_totals(uid)[CT_EXCEPT_COUNT]:
+            continue
+        for i, record in enumerate(index.records(uid), index.user_first(uid)):
+            if classification.is_excepted(i) and \
+               not permanent.search(record.path):
+                uids.add(uid)
+                break
+    return uids
+
+
+def diff_generations(args):
+    """ Compare the candidate files of two generations, by default the
+    current one and the one before, with the files added, removed and
+    still there of each user.
+
+    With args.enforce, the exceptions of users who had exceptions in place
+    in each of the two generations before are withdrawn, leaving only the
+    permanent exceptions to them.
+    """
+    (config_path,
+     find_path,
+     user_exceptions,
+     path_exceptions) = load_configuration(args.dirname)
+
+    names = list_generations(config_path)
+    new = args.new or os.path.basename(generation_path(config_path))
+    if new not in names:
+        if not args.new:
+            sys.stderr.write('ERROR: You must run find first.\n')
+        else:
+            sys.stderr.write('ERROR: there is no generation {0}\n'.format(new))
+        sys.exit(1)
+
+    earlier = names[:names.index(new)]
+    old = args.old or (earlier and earlier[-1])
+    if not old:
+        sys.stderr.write('ERROR: there is no generation before {0}\n'.format(
+                             new))
+        sys.exit(1)
+    if old not in names:
+        sys.stderr.write('ERROR: there is no generation {0}\n'.format(old))
+        sys.exit(1)
+
+    generations_path = os.path.join(config_path, GENERATIONS_DIR_NAME)
+    old_index = open_candidate_index(os.path.join(generations_path, old))
+    new_index = open_candidate_index(os.path.join(generations_path, new))
+
+    print('Candidate files of {0} since {1}\n'.format(new, old))
+    print('User, AddedCount AddedBytes RemovedCount RemovedBytes '
+          'PersistingCount PersistingBytes')
+    totals = [0, 0, 0, 0, 0, 0]
+    for uid, counts in generation_diff(old_index, new_index):
+        print('{0} {1} {2} {3} {4} {5} {6}'.format(
+            accounts.user_name(uid) or uid,
+            counts[0], format_bytes(counts[1]),
+            counts[2], format_bytes(counts[3]),
+            counts[4], format_bytes(counts[5])))
+        totals = [total + count for total, count in zip(totals, counts)]
+    print('Total {0} {1} {2} {3} {4} {5}'.format(
+        totals[0], format_bytes(totals[1]),
+        totals[2], format_bytes(totals[3]),
+        totals[4], format_bytes(totals[5])))
+
+    if not args.enforce:
+        return
+
+    if Config.permanent_users is None:
+        sys.stderr.write(
+            'CONFIG_ERROR: permanent needs to list the exceptions that '
+            'are never withdrawn\n')
+        sys.exit(1)
+    # each deletion is counted once, by the last generation before it, so
+    # that find run again, merged shards or a rollback do not advance it.
+    new_path = os.path.join(generations_path, new)
+    new_date = generation_deletion_date(new_path)
+    deletions = {}
+    for name in earlier:
+        date = generation_deletion_date(os.path.join(generations_path, name))
+        if date < new_date:
+            deletions[date] = name
+    if len(deletions) < 2:
+        sys.stderr.write(
+            'ERROR: there are not two deletions before {0}\n'.format(new))
+        sys.exit(1)
+
+    # the verdicts saved with each generation are the exceptions that were
+    # in place for its deletion.
+    repeated = None
+    for date in sorted(deletions)[-2:]:
+        name = deletions[date]
+        path = os.path.join(generations_path, name)
+        index = open_candidate_index(path)
+        classification = Classification.load(os.path.join(path,
+                                                          CLASSIFICATION))
+        if classification is None or \
+           classification.index_id != [index.count, index.mtime]:
+            sys.stderr.write(
+                'ERROR: {0} has no classification to compare.\n'.format(name))
+            sys.exit(1)
+        uids = exception_users(index, classification)
+        if repeated is not None:
+            uids &= repeated
+        repeated = uids
+
+    classification = load_classification(
+                       new_path, new_index, user_exceptions, path_exceptions,
+                       find_path)
+    withdrawn = repeated & exception_users(new_index, classification)
+
+    print('\nExceptions withdrawn, in place for the two previous deletions')
+    print('-------------------------------------------------------------')
+    for uid in sorted(withdrawn):
+        totals = classification.user_totals(uid)
+        print('{0} {1} {2}'.format(
+            accounts.user_name(uid) or uid, totals[CT_EXCEPT_COUNT],
+            format_bytes(totals[CT_EXCEPT_BYTES])))
+
+    withdrawn |= set(classification.withdrawn)
+    if not args.check and sorted(withdrawn) != classification.withdrawn:
+        write_json_file(os.path.join(new_path, WITHDRAWN_EXCEPTIONS),
+                        {'uids': sorted(withdrawn)})
+        load_classification(new_path, new_index, user_exceptions,
+                            path_exceptions, find_path)
+
+
+def generation_deletion_date(data_path):
+    """ Return the date of the deletion of the generation data_path.
+    """
+    return calculate_deletion_date(
+             os.path.join(data_path, FILES_TO_DELETE)).date()
+
 
 def output_crontab(dir_path):
     """Output crontab options based on file deletion list creation date
@@ -703,7 +4198,8 @@ def output_crontab(dir_path):
     """
 
     config_path = os.path.join(dir_path, CONFIG_DIR_NAME)
-    files_to_delete_path  = os.path.join(config_path, FILES_TO_DELETE)
+    files_to_delete_path  = os.path.join(generation_path(config_path),
+                                         FILES_TO_DELETE)
 
     # if find has not been run, then just pick first day of month to
     # run cronjobs.
@@ -796,6 +4292,10 @@ def init_files(args):
 last_access_days  = 60
 notify_days       = 14 
 mail_server       = localhost
+mail_rate         = 6
+metrics_textfile  =
+sort_memory       = 256M
+generations       = 3
 admin_email       = admin
 from_email        = admin@widgets.com
 from_name         = Support
@@ -806,6 +4306,10 @@ user =
 path =
    /no-delete/
    /.
+permanent =
+   root
+   /no-delete/
+   /.
 
 [messages]
 user_subject =
@@ -878,6 +4382,8 @@ def load_configuration(dir_name):
     # load configuration
     parser = SafeConfigParser()
     parser.read(config_file_path)
+
+    accounts.load(os.path.join(config_path, ACCOUNTS_SNAPSHOT))
   
     # TBD  -  configuration checks needed - sanity checks.
     Config.last_access_days = int(parser.get(
@@ -892,6 +4398,24 @@ def load_configuration(dir_name):
         sys.exit(1)
 
     Config.mail_server = parser.get('messages', 'mail_server')
+    if parser.has_option('messages', 'mail_rate'):
+        Config.mail_rate = float(parser.get('messages', 'mail_rate'))
+    if parser.has_option('messages', 'metrics_textfile'):
+        Config.metrics_textfile = \
+            parser.get('messages', 'metrics_textfile').strip()
+    if parser.has_option('messages', 'sort_memory'):
+        try:
+            Config.sort_memory = size_argument(
+                                   parser.get('messages', 'sort_memory'))
+        except argparse.ArgumentTypeError, e:
+            sys.stderr.write('CONFIG_ERROR: sort_memory {0}\n'.format(e))
+            sys.exit(1)
+    if parser.has_option('messages', 'generations'):
+        Config.generations = int(parser.get('messages', 'generations'))
+        if Config.generations < 2:
+            sys.stderr.write(
+                'CONFIG_ERROR: generations needs to be >= 2\n')
+            sys.exit(1)
     Config.admin_email = parser.get('messages', 'admin_email')
 
     Config.from_email = parser.get('messages', 'from_email')
@@ -910,10 +4434,10 @@ def load_configuration(dir_name):
         if e.isdigit():
             user_exceptions.append(int(e))
         else:
-            try:
-                userid = pwd.getpwnam(e).pw_uid
+            userid = accounts.uid(e)
+            if userid is not None:
                 user_exceptions.append(userid)
-            except KeyError:
+            else:
                 sys.stderr.write(
                     'ERROR: invalid username in user exceptions file -> ' + \
                     e + '\n' )
@@ -925,7 +4449,30 @@ def load_configuration(dir_name):
         if e != '' and not e.startswith('#'):
             path_exceptions.append(e)
 
-    return (config_path, dir_path, user_exceptions, path_exceptions)
+    # load the user and path exceptions that diff --enforce never withdraws.
+    Config.permanent_users = None
+    Config.permanent_paths = []
+    if parser.has_option('exceptions', 'permanent'):
+        Config.permanent_users = []
+        for e in parser.get('exceptions', 'permanent').split('\n'):
+            e = e.strip()
+            if e == '' or e.startswith('#'):
+                continue
+
+            if e in path_exceptions:
+                Config.permanent_paths.append(e)
+            elif e.isdigit():
+                Config.permanent_users.append(int(e))
+            elif accounts.uid(e) is not None:
+                Config.permanent_users.append(accounts.uid(e))
+            else:
+                sys.stderr.write(
+                    'CONFIG_ERROR: permanent exception {0} is not a user or '
+                    'path exception\n'.format(e))
+                sys.exit(1)
+
+    return (config_path, dir_path, user_exceptions,
+            PathMatcher(path_exceptions))
 
 
 def list_files(args):
@@ -938,10 +4485,13 @@ def list_files(args):
      user_exceptions,
      path_exceptions) = load_configuration(args.dirname)
 
-    user_cache_path = os.path.join(config_path, CACHE_DIR_NAME)
-    assert os.path.exists(user_cache_path)
+    data_path = generation_path(config_path)
+    index = open_candidate_index(data_path)
+    classification = load_classification(
+                       data_path, index, user_exceptions, path_exceptions,
+                       find_path)
 
-    files_to_delete_path = os.path.join(config_path, FILES_TO_DELETE)
+    files_to_delete_path = os.path.join(data_path, FILES_TO_DELETE)
     deletion_date = calculate_deletion_date(files_to_delete_path)
     deletion_datestr =  deletion_date.strftime('%a %d %B %Y')
 
@@ -959,14 +4509,7 @@ def list_files(args):
         
 
     if args.user == None:
-        if args.exceptions:
-            for file in list_all_files_to_except(
-                    user_cache_path, user_exceptions, path_exceptions):
-                print(file)
-        else:
-            for file in list_all_files_to_delete(
-                    user_cache_path, user_exceptions, path_exceptions):
-                print(file)
+        uids = index.uids()
 
     else:
         user_uid = check_user_exists(args.user)
@@ -979,19 +4522,59 @@ def list_files(args):
                 sys.exit(1)
 
 
-        user_file_path = os.path.join(user_cache_path, user_uid)
-        if not os.path.exists(user_file_path):
+        user_uid = int(user_uid)
+        if not index.user_count(user_uid):
             print("User {0} has no files to delete".format(args.user))
             sys.exit(0)
+        uids = [user_uid]
 
-        if args.exceptions:
-            for file in list_user_files_to_except(
-                    user_file_path, user_exceptions, path_exceptions):
-                print(file)
-        else:
-            for file in list_user_files_to_delete(
-                    user_file_path, user_exceptions, path_exceptions):
-                print(file)
+    under = args.under and os.path.abspath(args.under)
+    if args.tree:
+        if args.exceptions or args.min_size:
+            sys.stderr.write('ERROR: --tree can not be used with '
+                             '--exceptions or --min-size.\n')
+            sys.exit(1)
+
+        rollup = open_rollup(data_path, index, classification)
+        if rollup is None:
+            sys.stderr.write(
+                'ERROR: no directory rollup, run find again.\n')
+            sys.exit(1)
+        for entry, level in rollup_tree(
+                rollup, uids, under or rollup.root, args.depth):
+            print('{0}{1} {2} {3} {4} {5}'.format(
+                '  ' * level, entry.path, entry.count, format_bytes(entry.size),
+                time.strftime('%Y-%m-%d', time.localtime(entry.min_atime)),
+                time.strftime('%Y-%m-%d', time.localtime(entry.max_atime))))
+        return
+
+    if args.summary:
+        directories = list_summary(
+            index, classification, uids, find_path, args.exceptions,
+            under, args.min_size)
+        for directory, count, size in directories:
+            print('{0} {1} {2}'.format(directory, count, format_bytes(size)))
+        print('Total {0} {1}'.format(
+            sum(d[1] for d in directories),
+            format_bytes(sum(d[2] for d in directories))))
+        return
+
+    for record in list_candidates(
+            index, classification, uids, args.exceptions, under,
+            args.min_size, args.sort, args.offset, args.limit,
+            args.sort and sort_path(config_path)):
+        print(record.path)
+
+
+def size_argument(value):
+    """ argparse type of a size in bytes, with an optional K, M, G or T
+    suffix.
+    """
+    match = re.match(r'^(\d+)([KMGT]?)B?$', value.upper())
+    if not match:
+        raise argparse.ArgumentTypeError(
+            "'{0}' is not a size, eg. 100M".format(value))
+    return int(match.group(1)) << (10 * ' KMGT'.index(match.group(2) or ' '))
 
 def is_group_member(group_name):
     """ Returns true if the current user is a member of group_name
@@ -1016,7 +4599,7 @@ def main():
     # root or not.
     #
     # http://pymotw.com/2/pwd/
-    real_user = pwd.getpwuid(os.getuid()).pw_name
+    real_user = accounts.user_name(os.getuid())
     
     parser = argparse.ArgumentParser(description='Expires files!')
     subparsers = parser.add_subparsers(help='commands')
@@ -1028,6 +4611,29 @@ def main():
             '--exceptions', help='list exceptions', action='store_true')
     list_parser.add_argument(
                 '--check', help='check mode', action="store_true")
+    list_parser.add_argument(
+            '--under', help='only files under this directory', action='store')
+    list_parser.add_argument(
+            '--min-size', help='only files of at least this size, eg. 100M',
+            type=size_argument, action='store', default=0)
+    list_parser.add_argument(
+            '--sort', help='oldest (atime) or largest (size) files first',
+            choices=['atime', 'size'], action='store')
+    list_parser.add_argument(
+            '--offset', help='skip this many files', type=int,
+            action='store', default=0)
+    list_parser.add_argument(
+            '--limit', help='list at most this many files', type=int,
+            action='store')
+    list_parser.add_argument(
+            '--summary', help='count files and bytes by directory',
+            action='store_true')
+    list_parser.add_argument(
+            '--tree', help='show the directories holding files to delete',
+            action='store_true')
+    list_parser.add_argument(
+            '--depth', help='levels of directories shown by --tree', type=int,
+            action='store', default=2)
     list_parser.set_defaults(func=list_files)
 
     if real_user != 'root' and not is_group_member(SUPPORT_GROUP):
@@ -1051,7 +4657,74 @@ def main():
                 'dirname', action='store', help='Directory ')
         find_parser.add_argument(
                 '--prefix', help='path prefix', action="store")
+        find_parser.add_argument(
+                '--workers', help='number of scanner threads', type=int,
+                action="store", default=SCAN_WORKERS)
+        find_parser.add_argument(
+                '--resume', help='continue an interrupted find',
+                action="store_true")
+        find_parser.add_argument(
+                '--incremental',
+                help='skip directories unchanged since the last find',
+                action="store_true")
+        find_parser.add_argument(
+                '--max-rate', help='maximum stat calls per second',
+                type=int, action="store", default=0)
+        find_parser.add_argument(
+                '--latency-target',
+                help='slow down if the 99th percentile stat latency is over '
+                     'this many milliseconds', type=float, action="store",
+                default=0)
+        find_parser.add_argument(
+                '--shard', help='scan only shard I (from 0) of N of the tree',
+                type=shard_argument, action="store", metavar='I/N')
         find_parser.set_defaults(func=find_files)
+
+        merge_parser = subparsers.add_parser(
+                'merge', help='merge the shards of a sharded find')
+        merge_parser.add_argument(
+                'dirname', action='store', help='Directory ')
+        merge_parser.add_argument(
+                '--shards', help='number of shards', type=int,
+                action="store", required=True)
+        merge_parser.add_argument(
+                '--prefix', help='path prefix', action="store")
+        merge_parser.set_defaults(func=merge_shards)
+
+        generations_parser = subparsers.add_parser(
+                'generations', help='list the generations of the find lists')
+        generations_parser.add_argument(
+                'dirname', action='store', help='Directory ')
+        generations_parser.set_defaults(func=show_generations)
+
+        rollback_parser = subparsers.add_parser(
+                'rollback', help='go back to an earlier generation')
+        rollback_parser.add_argument(
+                'dirname', action='store', help='Directory ')
+        rollback_parser.add_argument(
+                '--generation', help='generation to go back to, by default '
+                                     'the one before the current',
+                action='store')
+        rollback_parser.set_defaults(func=rollback_generation)
+
+        diff_parser = subparsers.add_parser(
+                'diff', help='compare the candidate files of two generations')
+        diff_parser.add_argument(
+                'dirname', action='store', help='Directory ')
+        diff_parser.add_argument(
+                '--old', help='earlier generation, by default the one before '
+                              'the newer', action='store')
+        diff_parser.add_argument(
+                '--new', help='newer generation, by default the current',
+                action='store')
+        diff_parser.add_argument(
+                '--enforce', help='withdraw the exceptions of users who had '
+                                  'exceptions for the two previous '
+                                  'deletions',
+                action='store_true')
+        diff_parser.add_argument(
+                '--check', help='check mode', action="store_true")
+        diff_parser.set_defaults(func=diff_generations)
     
         #create_parser = subparsers.add_parser(
         #        'create', help='create user files')
@@ -1076,12 +4749,33 @@ def main():
                 '--check', help='check mode', action="store_true")
         remove_parser.add_argument(
                 '--prefix', help='path prefix', action="store")
+        remove_parser.add_argument(
+                '--workers', help='number of remove threads', type=int,
+                action="store", default=REMOVE_WORKERS)
+        remove_parser.add_argument(
+                '--max-rate', help='maximum files removed per second',
+                type=int, action="store", default=0)
+        remove_parser.add_argument(
+                '--latency-target',
+                help='slow down if the 99th percentile stat/unlink latency '
+                     'is over this many milliseconds', type=float,
+                action="store", default=0)
         remove_parser.add_argument(
                 'dirname', action='store', help='Directory ')
         remove_parser.set_defaults(func=remove_files)
     
     args = parser.parse_args()
-    args.func(args)
+    state = 'failed'
+    try:
+        args.func(args)
+        state = 'done'
+    except SystemExit, e:
+        if not e.code:
+            state = 'done'
+        raise
+    finally:
+        metrics.finish(state)
+        accounts.save()
 
     return
 
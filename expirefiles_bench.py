@@ -0,0 +1,568 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Benchmarks for expirefiles.py.
+
+    Each benchmark times the current implementation against the code it
+    replaced on synthetic data, so a change can be measured without a
+    production filesystem.
+
+    Examples
+    --------
+
+    Path exception matching with 300 exceptions over 200000 paths.
+    ~~~
+    $ expirefiles_bench.py matcher --paths 200000 --exceptions 300
+    ~~~
+
+    Reading a 4 GB files_to_delete.raw and the matching records file,
+    generated under /scratch/tmp.
+    ~~~
+    $ expirefiles_bench.py readlines --size 4096 --dir /scratch/tmp
+    ~~~
+
+    Each phase of a run, find, create_user_files, notify --check, list and
+    remove --check, on a generated tree of 500000 files in a tmpfs, with the
+    results saved as JSON to compare with those of another commit.
+    ~~~
+    $ expirefiles_bench.py phases --files 500000 --dir /dev/shm \\
+          --output phases.json
+    ~~~
+
+author:  Danny Sheehan
+license: GPL
+"""
+#==============================================================================
+
+import sys
+import os
+import argparse
+import random
+import time
+import shutil
+import tempfile
+import collections
+import itertools
+import subprocess
+import resource
+import json
+import bisect
+import datetime
+from ConfigParser import SafeConfigParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import expirefiles
+
+
+# owners of the generated files are given uids from this one, above those
+# of any real account.
+BENCH_UID_BASE = 900000
+
+# the phases timed by the phases benchmark, with their expirefiles.py
+# arguments. create_user_files has no command of its own.
+PHASES = collections.OrderedDict([
+    ('find', ['find']),
+    ('create', None),
+    ('notify', ['notify', '--check']),
+    ('list', ['list']),
+    ('remove', ['remove', '--check']),
+])
+
+# os functions counted as system calls during a phase, with the read and
+# write calls of /proc/self/io.
+COUNTED_CALLS = ('stat', 'lstat', 'fstat', 'listdir', 'open', 'close',
+                 'unlink', 'remove', 'rename', 'mkdir', 'fsync')
+
+
+def synthetic_paths(count, users=200, seed=1):
+    """ Return count paths shaped like a scratch filesystem,
+    /scratch/<user>/<project>/<dir>/.../<file>
+    """
+    rand = random.Random(seed)
+    paths = []
+    while len(paths) < count:
+        user = 'user{0}'.format(rand.randint(1, users))
+        project = 'project{0}'.format(rand.randint(1, 20))
+        dirs = ['run{0:04d}'.format(rand.randint(1, 500))
+                    for i in range(rand.randint(1, 4))]
+        prefix = '/'.join(['/scratch', user, project] + dirs)
+        for i in range(rand.randint(1, 50)):
+            paths.append('{0}/output_{1:06d}.{2}'.format(
+                prefix, rand.randint(1, 999999),
+                rand.choice(['dat', 'log', 'h5', 'nc', 'out'])))
+    return paths[:count]
+
+
+def synthetic_exceptions(count, users=200, seed=2):
+    """ Return count path exceptions, the defaults plus per project and
+    per user snippets.
+    """
+    rand = random.Random(seed)
+    exceptions = ['/no-delete/', '/.']
+    while len(exceptions) < count:
+        exceptions.append(rand.choice([
+            '/scratch/user{0}/project{1}/'.format(
+                rand.randint(1, users * 5), rand.randint(1, 20)),
+            '/run{0:04d}/'.format(rand.randint(1, 5000)),
+            '_keep_{0}'.format(rand.randint(1, 1000)),
+        ]))
+    return exceptions
+
+
+def legacy_search(path_exceptions, filename):
+    """ The per file test used before PathMatcher.
+    """
+    is_exception = [e for e in path_exceptions
+                        if filename.find(e) != -1 ]
+    return bool(is_exception)
+
+
+def legacy_readlines(filename, bufsize=1024, line_terminator='\0'):
+    """ The reader used before expirefiles.readlines, of small
+    f.read(bufsize) chunks each joined onto the buffer and split again.
+    """
+
+    buf = ''
+    with open(filename, 'r') as f:
+        data = f.read(bufsize)
+        while data:
+            buf += data
+            lines = buf.split(line_terminator)
+            buf = lines.pop()
+            for line in lines: yield line
+            data = f.read(bufsize)
+
+
+def legacy_read_records(filename, bufsize=1024 * 1024):
+    """ The reader used before expirefiles.read_records, of
+    f.read(bufsize) chunks appended to a buffer the records are parsed from.
+    """
+
+    header = expirefiles.RECORD_HEADER
+    with open(filename, 'rb') as f:
+        buf = ''
+        pos = 0
+        while True:
+            if len(buf) - pos >= header.size:
+                fields = header.unpack_from(buf, pos)
+                end = pos + header.size + fields[-1]
+                if end <= len(buf):
+                    yield expirefiles.FileRecord(
+                            buf[pos + header.size:end], *fields[:-1])
+                    pos = end
+                    continue
+
+            data = f.read(bufsize)
+            if not data:
+                return
+            buf = buf[pos:] + data
+            pos = 0
+
+
+def write_candidate_files(dir_path, size_mb):
+    """ Write files_to_delete.raw and files_to_delete.rec of about size_mb
+    megabytes of synthetic paths under dir_path and return their paths.
+    """
+    Stat = collections.namedtuple(
+             'Stat', 'st_uid st_gid st_size st_atime st_mtime st_ino')
+
+    raw_path = os.path.join(dir_path, expirefiles.FILES_TO_DELETE)
+    rec_path = os.path.join(dir_path, expirefiles.FILES_TO_DELETE_RECORDS)
+    paths = synthetic_paths(100000)
+    st = Stat(1000, 1000, 4096, 1000000000, 1000000000, 1)
+    raw_chunk = ''.join([p + '\0' for p in paths])
+    rec_chunk = ''.join([expirefiles.pack_record(p, st) for p in paths])
+    with open(raw_path, 'wb') as raw, open(rec_path, 'wb') as rec:
+        while raw.tell() < size_mb * 1024 * 1024:
+            raw.write(raw_chunk)
+            rec.write(rec_chunk)
+
+    return raw_path, rec_path
+
+
+def generate_tree(top, args, last_access_days):
+    """ Create args.files empty files under top, in directories args.depth
+    deep with args.fanout subdirectories each, and return the number of
+    directories and of files not accessed for last_access_days.
+
+    The owner of each directory of files is drawn from args.users uids, the
+    one of rank r with a weight of 1 / r ** args.skew. A fraction args.old
+    of the files were last accessed between last_access_days and
+    args.max_age days ago, the others more recently, and a fraction
+    args.exception_rate are hidden files, excepted by the default '/.'
+    path exception. Sizes are sparse and log-normally distributed.
+    """
+    rand = random.Random(args.seed)
+    cumulative = []
+    total = 0.0
+    for rank in range(args.users):
+        total += 1.0 / (rank + 1) ** args.skew
+        cumulative.append(total)
+
+    leaves = ['']
+    for level in range(args.depth):
+        leaves = ['{0}/d{1:03d}'.format(leaf, i)
+                      for leaf in leaves for i in range(args.fanout)]
+
+    owners = {}
+    candidates = 0
+    now = time.time()
+    is_root = os.getuid() == 0
+    for i in range(args.files):
+        leaf = rand.choice(leaves)
+        dir_path = top + leaf
+        if leaf not in owners:
+            owners[leaf] = BENCH_UID_BASE + bisect.bisect(
+                               cumulative, rand.random() * total)
+            os.makedirs(dir_path)
+            if is_root:
+                os.chown(dir_path, owners[leaf], owners[leaf])
+
+        name = 'file{0:07d}.dat'.format(i)
+        if rand.random() < args.exception_rate:
+            name = '.' + name
+        path = os.path.join(dir_path, name)
+        with open(path, 'wb') as f:
+            f.truncate(min(int(rand.lognormvariate(10, 3)), 1 << 40))
+        if is_root:
+            os.lchown(path, owners[leaf], owners[leaf])
+
+        if rand.random() < args.old:
+            days = rand.uniform(last_access_days + 2, args.max_age)
+            candidates += 1
+        else:
+            days = rand.uniform(0, last_access_days - 1)
+        os.utime(path, (now - days * 86400, now - days * 86400))
+
+    return len(owners), candidates
+
+
+def counted(func, counter):
+    """ Return func, counting its calls with counter.
+    """
+    def wrapper(*args, **kwargs):
+        next(counter)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def count_calls():
+    """ Count the calls of COUNTED_CALLS and of the directory reads,
+    unlinkat and openat calls of expirefiles, and return the counters by
+    name.
+    """
+    counters = {}
+    for name in COUNTED_CALLS:
+        counters[name] = itertools.count()
+        setattr(os, name, counted(getattr(os, name), counters[name]))
+    for name in ('scandir', '_libc_unlinkat', '_libc_openat'):
+        if getattr(expirefiles, name, None) is not None:
+            counters[name.split('_')[-1]] = itertools.count()
+            setattr(expirefiles, name, counted(getattr(expirefiles, name),
+                                               counters[name.split('_')[-1]]))
+    return counters
+
+
+def proc_io():
+    """ Return the counters of /proc/self/io, empty if there are none.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            return dict((name, int(value)) for name, value in
+                            (line.split(':') for line in f))
+    except IOError:
+        return {}
+
+
+def git_commit():
+    """ Return the commit expirefiles.py is checked out at, if known.
+    """
+    try:
+        return subprocess.check_output(
+                   ['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'w'),
+                   cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_phase(args):
+    """ Run one phase of expirefiles.py in this process and write its
+    time, resource usage and call counts to args.result as JSON.
+    """
+    counters = count_calls()
+    if PHASES[args.phase] is None:
+        create_args = argparse.Namespace(dirname=args.dirname, prefix=None)
+        func = lambda: expirefiles.create_user_files(create_args)
+        if hasattr(expirefiles, 'new_generation'):
+            # the index is built from the current lists into a new
+            # generation, which links them rather than time a copy.
+            config_path = os.path.join(os.path.abspath(args.dirname),
+                                       expirefiles.CONFIG_DIR_NAME)
+            data_path = expirefiles.generation_path(config_path)
+            build_path = expirefiles.new_generation(config_path)
+            for name in (expirefiles.FILES_TO_DELETE,
+                         expirefiles.FILES_TO_DELETE_RECORDS):
+                os.link(os.path.join(data_path, name),
+                        os.path.join(build_path, name))
+            func = lambda: expirefiles.create_user_files(
+                               create_args, build_path)
+    else:
+        sys.argv = ['expirefiles.py'] + PHASES[args.phase] + [args.dirname]
+        func = expirefiles.main
+
+    status = 0
+    start = time.time()
+    try:
+        func()
+    except SystemExit, e:
+        status = e.code or 0
+    secs = time.time() - start
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    io = proc_io()
+    calls = dict((name, next(counter)) for name, counter in counters.items())
+    for name in ('syscr', 'syscw'):
+        if name in io:
+            calls[name == 'syscr' and 'read' or 'write'] = io[name]
+
+    with open(args.result, 'w') as f:
+        json.dump(collections.OrderedDict([
+            ('status', status),
+            ('secs', secs),
+            ('user_secs', usage.ru_utime),
+            ('system_secs', usage.ru_stime),
+            ('max_rss_kb', usage.ru_maxrss),
+            ('read_bytes', io.get('rchar')),
+            ('write_bytes', io.get('wchar')),
+            ('calls', collections.OrderedDict(sorted(calls.items())))]), f)
+
+
+def bench_phases(args):
+    """ Time each phase of expirefiles.py on a generated tree, each in a
+    process of its own.
+    """
+    top = tempfile.mkdtemp(prefix='expirefiles_bench.', dir=args.dir)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'expirefiles.py')
+    devnull = open(os.devnull, 'w')
+    try:
+        subprocess.check_call([sys.executable, script, 'init', top],
+                              stdout=devnull)
+        config = SafeConfigParser()
+        config.read(os.path.join(top, expirefiles.CONFIG_DIR_NAME,
+                                 expirefiles.CONFIG_FILE))
+        last_access_days = config.getint('DEFAULT', 'last_access_days')
+
+        (directories, candidates), generate_secs = timed(
+            generate_tree, top, args, last_access_days)
+        results = collections.OrderedDict([
+            ('commit', git_commit()),
+            ('time', datetime.datetime.now().isoformat()),
+            ('python', sys.version.split()[0]),
+            ('tree', collections.OrderedDict([
+                ('files', args.files),
+                ('directories', directories),
+                ('candidates', candidates),
+                ('depth', args.depth),
+                ('fanout', args.fanout),
+                ('users', args.users),
+                ('skew', args.skew),
+                ('old', args.old),
+                ('max_age', args.max_age),
+                ('exception_rate', args.exception_rate),
+                ('seed', args.seed),
+                ('generate_secs', generate_secs)])),
+            ('phases', collections.OrderedDict())])
+        sys.stderr.write('{0} files, {1} candidates, generated in '
+                         '{2:.1f}s under {3}\n'.format(
+                             args.files, candidates, generate_secs, top))
+
+        result_path = os.path.join(top, expirefiles.CONFIG_DIR_NAME,
+                                   'phase.json')
+        for phase in args.phases:
+            child = subprocess.Popen(
+                        [sys.executable, os.path.abspath(__file__),
+                         'run-phase', result_path, phase, top],
+                        stdout=devnull, stderr=subprocess.PIPE)
+            errors = child.communicate()[1]
+            with open(result_path) as f:
+                result = json.load(f, object_pairs_hook=collections.OrderedDict)
+            os.remove(result_path)
+
+            # find reads every file, the other phases only the candidates.
+            files = phase == 'find' and args.files or candidates
+            result['files_per_sec'] = files / max(result['secs'], 0.000001)
+            result['calls_per_file'] = \
+                sum(result['calls'].values()) / float(max(files, 1))
+            if child.returncode:
+                result['errors'] = errors.strip().splitlines()[-5:]
+            results['phases'][phase] = result
+
+            sys.stderr.write(
+                '{0:8} {1:8.3f}s {2:10.0f} files/sec {3:8.0f} MB rss '
+                '{4:6.2f} calls/file{5}\n'.format(
+                    phase, result['secs'], result['files_per_sec'],
+                    result['max_rss_kb'] / 1024.0, result['calls_per_file'],
+                    child.returncode and ' FAILED' or ''))
+
+        output = json.dumps(results, indent=2) + '\n'
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output)
+        else:
+            sys.stdout.write(output)
+    finally:
+        if args.keep:
+            sys.stderr.write('tree kept in {0}\n'.format(top))
+        else:
+            shutil.rmtree(top)
+
+
+def phases_argument(value):
+    """ argparse type of --phases, a comma separated list of PHASES.
+    """
+    phases = value.split(',')
+    for phase in phases:
+        if phase not in PHASES:
+            raise argparse.ArgumentTypeError(
+                "'{0}' is not one of {1}".format(phase, ', '.join(PHASES)))
+    return phases
+
+
+def count_items(iterable):
+    return sum(1 for item in iterable)
+
+
+def timed(func, *args):
+    """ Return (result, seconds) of func(*args).
+    """
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def bench_matcher(args):
+    """ Time PathMatcher against the list comprehension it replaced.
+    """
+    paths = synthetic_paths(args.paths)
+    exceptions = synthetic_exceptions(args.exceptions)
+
+    matcher, compile_secs = timed(expirefiles.PathMatcher, exceptions)
+
+    legacy_hits, legacy_secs = timed(
+        lambda: sum(1 for p in paths if legacy_search(exceptions, p)))
+    matcher_hits, matcher_secs = timed(
+        lambda: sum(1 for p in paths if matcher.search(p)))
+
+    assert legacy_hits == matcher_hits
+
+    print('{0} paths, {1} exceptions, {2} excepted'.format(
+          len(paths), len(exceptions), matcher_hits))
+    print('compile  {0:8.3f}s'.format(compile_secs))
+    for name, secs in (('legacy', legacy_secs), ('matcher', matcher_secs)):
+        print('{0:8} {1:8.3f}s {2:12.0f} paths/sec'.format(
+              name, secs, len(paths) / max(secs, 0.000001)))
+    print('speedup  {0:8.1f}x'.format(legacy_secs / max(matcher_secs, 0.000001)))
+
+
+def bench_readlines(args):
+    """ Time the readers against the chunked f.read(bufsize) readers they
+    replaced.
+    """
+    dir_path = tempfile.mkdtemp(prefix='expirefiles_bench.', dir=args.dir)
+    try:
+        raw_path, rec_path = write_candidate_files(dir_path, args.size)
+        print('{0} MB paths, {1} MB records'.format(
+              os.path.getsize(raw_path) // (1024 * 1024),
+              os.path.getsize(rec_path) // (1024 * 1024)))
+
+        results = [
+          ('legacy readlines', legacy_readlines, raw_path, raw_path),
+          ('readlines', expirefiles.readlines, raw_path, raw_path),
+          ('legacy records', legacy_read_records, rec_path, raw_path),
+          ('records', expirefiles.read_records, rec_path, raw_path),
+        ]
+        for name, reader, path, raw_path in results:
+            count, secs = timed(count_items, reader(path))
+            print('{0:16} {1:8.3f}s {2:12.0f} lines/sec {3:8.1f} MB/sec'.format(
+                  name, secs, count / max(secs, 0.000001),
+                  os.path.getsize(path) / max(secs, 0.000001) / 1024 / 1024))
+    finally:
+        shutil.rmtree(dir_path)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark expirefiles.py')
+    subparsers = parser.add_subparsers(help='benchmarks')
+
+    matcher_parser = subparsers.add_parser(
+            'matcher', help='path exception matching')
+    matcher_parser.add_argument(
+            '--paths', help='number of paths', type=int, default=200000)
+    matcher_parser.add_argument(
+            '--exceptions', help='number of path exceptions', type=int,
+            default=300)
+    matcher_parser.set_defaults(func=bench_matcher)
+
+    readlines_parser = subparsers.add_parser(
+            'readlines', help='candidate list readers')
+    readlines_parser.add_argument(
+            '--size', help='size of the path list in MB', type=int,
+            default=256)
+    readlines_parser.add_argument(
+            '--dir', help='directory for the generated files', action='store')
+    readlines_parser.set_defaults(func=bench_readlines)
+
+    phases_parser = subparsers.add_parser(
+            'phases', help='each phase of expirefiles.py on a generated tree')
+    phases_parser.add_argument(
+            '--files', help='number of files', type=int, default=100000)
+    phases_parser.add_argument(
+            '--depth', help='depth of the directories', type=int, default=3)
+    phases_parser.add_argument(
+            '--fanout', help='subdirectories of each directory', type=int,
+            default=10)
+    phases_parser.add_argument(
+            '--users', help='number of owners', type=int, default=100)
+    phases_parser.add_argument(
+            '--skew', help='skew of files between owners, 0 for uniform',
+            type=float, default=1.0)
+    phases_parser.add_argument(
+            '--old', help='fraction of files that are candidates', type=float,
+            default=0.5)
+    phases_parser.add_argument(
+            '--max-age', help='days since the oldest access', type=int,
+            default=1000)
+    phases_parser.add_argument(
+            '--exception-rate', help='fraction of files path excepted',
+            type=float, default=0.05)
+    phases_parser.add_argument(
+            '--seed', help='random seed of the tree', type=int, default=1)
+    phases_parser.add_argument(
+            '--phases', help='comma separated phases to run, of '
+                             + ', '.join(PHASES), type=phases_argument,
+            default=list(PHASES))
+    phases_parser.add_argument(
+            '--dir', help='directory for the tree, eg. a tmpfs',
+            action='store')
+    phases_parser.add_argument(
+            '--output', help='write the JSON results to this file',
+            action='store')
+    phases_parser.add_argument(
+            '--keep', help='keep the tree', action='store_true')
+    phases_parser.set_defaults(func=bench_phases)
+
+    run_phase_parser = subparsers.add_parser(
+            'run-phase', help='run one phase, used by phases')
+    run_phase_parser.add_argument('result', help='JSON results file')
+    run_phase_parser.add_argument('phase', choices=list(PHASES))
+    run_phase_parser.add_argument('dirname', help='Directory ')
+    run_phase_parser.set_defaults(func=run_phase)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()